@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# message_memory.py - Memory and time taken to load a whole corpus of
+# sessions, and to serialize it again, with chap's Message and with a plain
+# dataclass Message serialized through dataclasses.asdict, as chap used to
+# have.
+#
+# Usage: benchmarks/message_memory.py [session directory]
+#
+# Without a directory, a corpus of 2000 sessions of 101 short messages is
+# made in a temporary directory.
+
+import gc
+import json
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from typing import Any, Callable
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "src"))
+
+from chap.session import (  # noqa: E402
+    Assistant,
+    User,
+    new_session,
+    session_files,
+    session_from_file,
+    session_to_file,
+    session_to_json,
+)
+
+
+@dataclass
+class PlainMessage:
+    role: str
+    content: str
+
+
+def plain_session_from_file(path: pathlib.Path) -> list[PlainMessage]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [PlainMessage(**mapping) for mapping in json.load(f)]
+
+
+def plain_session_to_json(session: list[PlainMessage]) -> str:
+    return json.dumps([asdict(message) for message in session])
+
+
+def make_corpus(directory: pathlib.Path, sessions: int, turns: int) -> None:
+    random.seed(0)
+    words = "alpha beta gamma delta epsilon zeta eta theta iota kappa".split()
+    for i in range(sessions):
+        session = new_session()
+        for _ in range(turns):
+            for role in (User, Assistant):
+                session.append(
+                    role(" ".join(random.choices(words, k=random.randint(3, 30))))
+                )
+        session_to_file(session, directory / f"{i}.json")
+
+
+def measure(
+    name: str,
+    paths: list[pathlib.Path],
+    load: Callable[[pathlib.Path], list[Any]],
+    dump: Callable[[list[Any]], str],
+) -> None:
+    gc.collect()
+    tracemalloc.start()
+    t = time.perf_counter()
+    sessions = [load(p) for p in paths]
+    load_time = time.perf_counter() - t
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    messages = sum(len(s) for s in sessions)
+    content = sum(sys.getsizeof(m.content) for s in sessions for m in s)
+    t = time.perf_counter()
+    for s in sessions:
+        dump(s)
+    dump_time = time.perf_counter() - t
+    print(
+        f"{name:6} retained {retained / 1e6:5.1f} MB"
+        f" ({(retained - content) / messages:4.0f} B/message beyond the content),"
+        f" load {load_time:.2f} s, serialize {dump_time:.2f} s"
+    )
+
+
+def main(directory: pathlib.Path) -> None:
+    paths = sorted(p for p in session_files(directory) if p.suffix == ".json")
+    # Read everything once, so both runs find the files in the page cache
+    for p in paths:
+        p.read_bytes()
+    messages = sum(len(session_from_file(p)) for p in paths)
+    print(f"{len(paths)} sessions, {messages} messages")
+    measure("plain", paths, plain_session_from_file, plain_session_to_json)
+    measure("chap", paths, session_from_file, session_to_json)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(pathlib.Path(sys.argv[1]))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            make_corpus(pathlib.Path(tmp), 2000, 50)
+            main(pathlib.Path(tmp))
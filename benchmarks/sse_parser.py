@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# sse_parser.py - Thousands of events per second that reading a streamed
+# response costs the client, with chap.sse and with reading it line by line
+# as the backends used to do.
+#
+# Usage: benchmarks/sse_parser.py
+#
+# Each response is 100k events of one token each, as OpenAI-style and
+# Anthropic servers send them, arriving 1 or 16 events at a time. The
+# events are split from the response, and then also decoded as JSON (with
+# orjson too, if it is installed). The best of 7 runs is shown.
+
+import asyncio
+import json
+import pathlib
+import sys
+import time
+from typing import Any, AsyncIterator, Callable, Coroutine
+
+import httpx
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "src"))
+
+from chap import sse  # noqa: E402
+
+events = 100_000
+runs = 7
+
+
+def openai_event(i: int) -> bytes:
+    data = {
+        "id": "chatcmpl-0",
+        "object": "chat.completion.chunk",
+        "created": 1,
+        "model": "model",
+        "choices": [
+            {"index": 0, "delta": {"content": f" token{i}"}, "finish_reason": None}
+        ],
+    }
+    return b"data: " + json.dumps(data).encode() + b"\n\n"
+
+
+def anthropic_event(i: int) -> bytes:
+    data = {
+        "type": "content_block_delta",
+        "index": 0,
+        "delta": {"type": "text_delta", "text": f" token{i}"},
+    }
+    return b"event: content_block_delta\ndata: " + json.dumps(data).encode() + b"\n\n"
+
+
+def response(chunks: list[bytes]) -> httpx.Response:
+    async def content() -> AsyncIterator[bytes]:
+        for chunk in chunks:
+            yield chunk
+
+    return httpx.Response(200, content=content())
+
+
+async def read_lines(r: httpx.Response) -> None:
+    async for line in r.aiter_lines():
+        if line.startswith("data:"):
+            line.removeprefix("data:").strip()
+
+
+async def read_events(r: httpx.Response) -> None:
+    async for _ in sse.aiter_events(r.aiter_bytes()):
+        pass
+
+
+async def decode_lines(r: httpx.Response) -> None:
+    async for line in r.aiter_lines():
+        if line.startswith("data:"):
+            json.loads(line.removeprefix("data:").strip())
+
+
+async def decode_events(r: httpx.Response) -> None:
+    async for _ in sse.aiter_json(r.aiter_bytes()):
+        pass
+
+
+def rate(
+    read: Callable[[httpx.Response], Coroutine[Any, Any, None]], chunks: list[bytes]
+) -> str:
+    best = 0.0
+    for _ in range(runs):
+        r = response(chunks)
+        t = time.perf_counter()
+        asyncio.run(read(r))
+        best = max(best, events / (time.perf_counter() - t))
+    return f"{best / 1000:.0f}k"
+
+
+def main() -> None:
+    loads = {"json": sse._decode_json}
+    try:
+        import orjson
+
+        loads["orjson"] = orjson.loads
+    except ImportError:
+        pass
+    columns = ["lines", "sse", "lines+json", *(f"sse+{name}" for name in loads)]
+    print(f"{'events/s':22}", *(f"{column:>10}" for column in columns))
+    for name, event in (("openai", openai_event), ("anthropic", anthropic_event)):
+        stream = [event(i) for i in range(events)]
+        for per_chunk in (1, 16):
+            chunks = [
+                b"".join(stream[i : i + per_chunk]) for i in range(0, events, per_chunk)
+            ]
+            result = [
+                rate(read_lines, chunks),
+                rate(read_events, chunks),
+                rate(decode_lines, chunks),
+            ]
+            for decode in loads.values():
+                sse.loads = decode
+                result.append(rate(decode_events, chunks))
+            print(
+                f"{name:9} {per_chunk:2} per chunk",
+                *(f"{column:>10}" for column in result),
+            )
+
+
+if __name__ == "__main__":
+    main()
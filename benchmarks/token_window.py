@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# token_window.py - Time taken to choose which messages of a 10k-message
+# session fit in a request, with chap's fit_history and with counting the
+# messages from the end on every request, as chap used to do.
+#
+# Usage: benchmarks/token_window.py [tokenizer]
+#
+# The tokenizer is given as for a backend's tokenizer parameter, such as
+# 'tiktoken:o200k_base'. By default, a byte-level BPE with a few merges
+# stands in for a tiktoken encoding, so that nothing has to be downloaded.
+
+import functools
+import pathlib
+import random
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "src"))
+
+from chap.session import (  # noqa: E402
+    Assistant,
+    Session,
+    System,
+    User,
+    session_from_json,
+    session_to_json,
+)
+from chap.tokens import (  # noqa: E402
+    TiktokenTokenizer,
+    Tokenizer,
+    TokenWindow,
+    fit_history,
+    get_tokenizer,
+)
+
+words = "the quick brown fox jumps over lazy dog lorem ipsum dolor sit amet".split()
+
+# As counted for OpenAI's chat models
+per_message = 4
+overhead = 3
+
+
+def synthetic_tokenizer() -> Tokenizer:
+    import tiktoken
+
+    ranks = {bytes([i]): i for i in range(256)}
+    for word in words:
+        for j in range(2, len(word) + 1):
+            ranks.setdefault(word[:j].encode(), len(ranks))
+    tokenizer = TiktokenTokenizer("synthetic")
+    tokenizer.encoding = tiktoken.Encoding(
+        "synthetic",
+        pat_str=r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
+        mergeable_ranks=ranks,
+        special_tokens={},
+    )
+    return tokenizer
+
+
+def text(n: int) -> str:
+    return " ".join(random.choices(words, k=n))
+
+
+def plain_fit_history(
+    count: Callable[[str], int], history: Session, max_tokens: int
+) -> Session:
+    # Count role and content of each message from the end, until the budget
+    # is used up
+    left = max_tokens - overhead - count(history[0].role) - count(history[0].content)
+    parts = []
+    for message in reversed(history[1:]):
+        size = count(message.role) + count(message.content) + per_message
+        if left < size:
+            break
+        left -= size
+        parts.append(message)
+    return [history[0], *reversed(parts)]
+
+
+def ms(t: float) -> str:
+    return f"{t * 1000:7.1f}ms"
+
+
+def run(tokenizer: Tokenizer, max_tokens: int, new: bool) -> None:
+    random.seed(0)
+    session = [System("sys")] + [
+        (User if i % 2 == 0 else Assistant)(text(random.randint(20, 400)))
+        for i in range(10000)
+    ]
+    if new:
+        window = TokenWindow()
+
+        def request(history: Session) -> Session:
+            return fit_history(
+                window, tokenizer, history, max_tokens, per_message, overhead
+            )
+
+    else:
+        count = functools.lru_cache(128)(tokenizer.count)
+
+        def request(history: Session) -> Session:
+            return plain_fit_history(count, history, max_tokens)
+
+    t = time.perf_counter()
+    request(session + [User("q")])
+    first = time.perf_counter() - t
+
+    reloaded = ""
+    if new:
+        # As for the first request of a new process, with the counts saved
+        # in the session file
+        session = session_from_json(session_to_json(session))
+        window = TokenWindow()
+        t = time.perf_counter()
+        request(session + [User("q")])
+        reloaded = f" {ms(time.perf_counter() - t)}"
+
+    later = 0.0
+    turns = 20
+    for _ in range(turns):
+        session += [User(text(200)), Assistant(text(300))]
+        t = time.perf_counter()
+        request(session + [User("q")])
+        later += time.perf_counter() - t
+
+    print(
+        f"{max_tokens:>10} {'chap' if new else 'plain':5} {ms(first)}"
+        f"{reloaded or ' ' * 9} {ms(later / turns)}"
+    )
+
+
+def main(spec: str) -> None:
+    tokenizer = synthetic_tokenizer() if spec == "synthetic" else get_tokenizer(spec)
+    print(f"{'max_tokens':>10} {'':5} {'first':>9} {'reloaded':>9} {'later':>9}")
+    for max_tokens in (1024, 100_000, 10_000_000):
+        run(tokenizer, max_tokens, False)
+        run(tokenizer, max_tokens, True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "synthetic")
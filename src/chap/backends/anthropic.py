@@ -8,9 +8,33 @@ from typing import AsyncGenerator, Any
 
 import httpx
 
+from ..clients import async_client
 from ..core import AutoAskMixin, Backend
+from ..fragments import FragmentCache, json_request_body, message_json
 from ..key import UsesKeyMixin
-from ..session import Assistant, Role, Session, User
+from ..session import Assistant, Message, Role, Session, System, User
+from ..sse import aiter_json
+from ..tokens import (
+    TokenWindow,
+    Tokenizer,
+    chat_message_tokens,
+    fit_history,
+    get_tokenizer,
+    in_thread,
+)
+
+
+# The most cache breakpoints a request may have
+max_cache_breakpoints = 4
+
+
+def cached_text(text: str) -> dict[str, Any]:
+    """A text content block that ends a prefix of the prompt to cache"""
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+
+def cached_message_json(message: Message) -> str:
+    return json.dumps({"role": message.role, "content": [cached_text(message.content)]})
 
 
 class Anthropic(AutoAskMixin, UsesKeyMixin):
@@ -21,73 +45,144 @@ class Anthropic(AutoAskMixin, UsesKeyMixin):
         max_new_tokens: int = 1000
         api_key_name = "anthropic_api_key"
 
+        max_request_tokens: int = 8192
+        """The approximate greatest number of tokens to send in a request. When the session is long, the system prompt and the most recent messages that fit are sent."""
+
+        tokenizer: str = "chars"
+        """How to count tokens: 'chars' (estimated as 4 characters per token, or e.g., 'chars:3.5'), 'tiktoken:ENCODING', or 'llama.cpp:URL'"""
+
+        trim_chunk: float = 0
+        """The fraction of max_request_tokens of old messages to leave out at once when the session is too long, so that cached prompts stay usable (0: as few as possible)"""
+
+        relevant_history: bool = False
+        """When the session is too long, fill half of each request with the earlier exchanges that best match the question, instead of only recent messages"""
+
+        cache_system: bool = True
+        """Mark the system prompt for prompt caching, so that the server can reuse its processing of it. (Prompts shorter than the model's minimum, e.g., 1024 tokens, are not cached.)"""
+
+        cache_messages: int = 2
+        """Mark this many of the most recent user messages, including the new one, for prompt caching: each request then reads the prompt cached by the previous one, and caches its own for the next. With 0, only the system prompt is cached. A request may have 4 cache marks in all."""
+
     def __init__(self) -> None:
         super().__init__()
         self.parameters = self.Parameters()
+        self.window = TokenWindow()
+        self.fragments = FragmentCache(message_json, ", ")
+        # The token usage the server reported for the last response,
+        # including the tokens read from and written to its prompt cache
+        self.usage: dict[str, int] = {}
 
     system_message = """\
 Answer each question accurately and thoroughly.
 """
 
-    def make_full_query(self, messages: Session, max_query_size: int) -> dict[str, Any]:
-        system = [m.content for m in messages if m.role == Role.SYSTEM]
-        messages = [m for m in messages if m.role != Role.SYSTEM and m.content]
-        del messages[:-max_query_size]
-        result = dict(
+    def get_tokenizer(self) -> Tokenizer:
+        return get_tokenizer(self.parameters.tokenizer)
+
+    def make_full_query(self, messages: Session) -> bytes:
+        system = [m for m in messages if m.role == Role.SYSTEM]
+        messages = fit_history(
+            self.window,
+            self.get_tokenizer(),
+            (system[:1] or [System("")])
+            + [m for m in messages if m.role != Role.SYSTEM and m.content],
+            self.parameters.max_request_tokens,
+            chat_message_tokens,
+            chunk=self.parameters.trim_chunk,
+            relevant=self.parameters.relevant_history,
+        )[1:]
+        # The conversation has to start with the user
+        if messages and messages[0].role == Role.ASSISTANT:
+            del messages[0]
+        fields: dict[str, Any] = dict(
             model=self.parameters.model,
             max_tokens=self.parameters.max_new_tokens,
-            messages=[dict(role=str(m.role), content=m.content) for m in messages],
             stream=True,
         )
-        if system and system[0]:
-            result["system"] = system[0]
-        return result
+        marks = max_cache_breakpoints
+        if system and system[0].content:
+            if self.parameters.cache_system:
+                fields["system"] = [cached_text(system[0].content)]
+                marks -= 1
+            else:
+                fields["system"] = system[0].content
+
+        # The messages from the first marked one on are encoded here, rather
+        # than kept in the fragment cache, since they are encoded differently
+        # once they are no longer marked
+        marks = min(marks, self.parameters.cache_messages)
+        marked: set[int] = set()
+        for i in range(len(messages) - 1, -1, -1):
+            if len(marked) >= marks:
+                break
+            if messages[i].role == Role.USER:
+                marked.add(i)
+        split = min(marked, default=len(messages))
+        more = [
+            cached_message_json(m) if i in marked else message_json(m)
+            for i, m in enumerate(messages[split:], split)
+        ]
+        return json_request_body(fields, messages[:split], self.fragments, more)
 
     async def aask(
         self,
         session: Session,
         query: str,
         *,
-        max_query_size: int = 5,
         timeout: float = 180,
     ) -> AsyncGenerator[str, None]:
+        user = User(query)
         new_content: list[str] = []
-        params = self.make_full_query(session + [User(query)], max_query_size)
+        self.usage = {}
+        body = await in_thread(
+            self.window, lambda: self.make_full_query(session + [user])
+        )
         try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                async with client.stream(
-                    "POST",
-                    f"{self.parameters.url}/v1/messages",
-                    json=params,
-                    headers={
-                        "x-api-key": self.get_key(),
-                        "content-type": "application/json",
-                        "anthropic-version": "2023-06-01",
-                        "anthropic-beta": "messages-2023-12-15",
-                    },
-                ) as response:
-                    if response.status_code == 200:
-                        async for line in response.aiter_lines():
-                            if line.startswith("data:"):
-                                data = line.removeprefix("data:").strip()
-                                j = json.loads(data)
-                                content = j.get("delta", {}).get("text", "")
-                                if content:
-                                    new_content.append(content)
-                                    yield content
-                    else:
-                        content = f"\nFailed with {response=!r}"
-                        new_content.append(content)
-                        yield content
-                        async for line in response.aiter_lines():
-                            new_content.append(line)
-                            yield line
+            client = async_client(self.parameters.url)
+            async with client.stream(
+                "POST",
+                f"{self.parameters.url}/v1/messages",
+                timeout=timeout,
+                content=body,
+                headers={
+                    "x-api-key": self.get_key(),
+                    "content-type": "application/json",
+                    "anthropic-version": "2023-06-01",
+                    "anthropic-beta": "messages-2023-12-15,prompt-caching-2024-07-31",
+                },
+            ) as response:
+                if response.status_code == 200:
+                    async for event, j in aiter_json(response.aiter_bytes()):
+                        if event == "error":
+                            # Such as when the API is overloaded mid-response
+                            content = f"\nFailed with {j.get('error', j)!r}"
+                            new_content.append(content)
+                            yield content
+                            continue
+                        # message_start reports the input tokens, and
+                        # message_delta the output so far
+                        usage = j.get("message", j).get("usage", {})
+                        self.usage.update(
+                            (k, v) for k, v in usage.items() if isinstance(v, int)
+                        )
+                        content = j.get("delta", {}).get("text", "")
+                        if content:
+                            new_content.append(content)
+                            yield content
+                else:
+                    content = f"\nFailed with {response=!r}"
+                    new_content.append(content)
+                    yield content
+                    async for line in response.aiter_lines():
+                        new_content.append(line)
+                        yield line
         except httpx.HTTPError as e:
             content = f"\nException: {e!r}"
             new_content.append(content)
             yield content
 
-        session.extend([User(query), Assistant("".join(new_content))])
+        session.extend([user, Assistant("".join(new_content))])
+        await in_thread(self.window, lambda: self.window.count_response(session[-1]))
 
 
 def factory() -> Backend:
@@ -2,15 +2,18 @@
 #
 # SPDX-License-Identifier: MIT
 
-import json
 from dataclasses import dataclass
 from typing import Any, AsyncGenerator
 
 import httpx
 
+from ..clients import async_client
 from ..core import AutoAskMixin, Backend
 from ..key import UsesKeyMixin
-from ..session import Assistant, Role, Session, User
+from ..fragments import FragmentCache
+from ..session import Assistant, Message, Role, Session, User
+from ..sse import aiter_json
+from ..tokens import TokenWindow, Tokenizer, fit_history, get_tokenizer, in_thread
 
 
 class HuggingFace(AutoAskMixin, UsesKeyMixin):
@@ -26,73 +29,106 @@ class HuggingFace(AutoAskMixin, UsesKeyMixin):
         stop_token_id = 2
         api_key_name = "huggingface_api_token"
 
+        max_request_tokens: int = 3072
+        """The approximate greatest number of tokens to send in a request. When the session is long, the system prompt and the most recent messages that fit are sent."""
+
+        tokenizer: str = "chars"
+        """How to count tokens: 'chars' (estimated as 4 characters per token, or e.g., 'chars:3.5'), 'tiktoken:ENCODING', or 'llama.cpp:URL'"""
+
+        trim_chunk: float = 0
+        """The fraction of max_request_tokens of old messages to leave out at once when the session is too long, so that cached prompts stay usable (0: as few as possible)"""
+
+        relevant_history: bool = False
+        """When the session is too long, fill half of each request with the earlier exchanges that best match the question, instead of only recent messages"""
+
     def __init__(self) -> None:
         super().__init__()
         self.parameters = self.Parameters()
+        self.window = TokenWindow()
+        self.fragments = FragmentCache(self.format_message)
 
     system_message = """\
 A dialog, where USER interacts with AI. AI is helpful, kind, obedient, honest, and knows its own limits.
 """
 
-    def make_full_query(self, messages: Session, max_query_size: int) -> str:
-        del messages[1:-max_query_size]
-        result = [self.parameters.start_prompt]
-        for m in messages:
-            content = (m.content or "").strip()
-            if not content:
-                continue
-            result.append(content)
-            if m.role == Role.SYSTEM:
-                result.append(self.parameters.after_system)
-            elif m.role == Role.ASSISTANT:
-                result.append(self.parameters.after_assistant)
-            elif m.role == Role.USER:
-                result.append(self.parameters.after_user)
-        full_query = "".join(result)
-        return full_query
+    def get_tokenizer(self) -> Tokenizer:
+        return get_tokenizer(self.parameters.tokenizer)
+
+    def format_message(self, message: Message) -> str:
+        content = (message.content or "").strip()
+        if not content:
+            return ""
+        if message.role == Role.SYSTEM:
+            return content + self.parameters.after_system
+        elif message.role == Role.ASSISTANT:
+            return content + self.parameters.after_assistant
+        elif message.role == Role.USER:
+            return content + self.parameters.after_user
+        return content
+
+    def make_full_query(self, messages: Session) -> str:
+        tokenizer = self.get_tokenizer()
+        messages = fit_history(
+            self.window,
+            tokenizer,
+            messages,
+            self.parameters.max_request_tokens,
+            max(
+                tokenizer.count(s)
+                for s in (
+                    self.parameters.after_system,
+                    self.parameters.after_user,
+                    self.parameters.after_assistant,
+                )
+            ),
+            tokenizer.count(self.parameters.start_prompt),
+            chunk=self.parameters.trim_chunk,
+            relevant=self.parameters.relevant_history,
+        )
+        return self.parameters.start_prompt + self.fragments.join(messages)
 
     async def chained_query(
         self, inputs: Any, timeout: float
     ) -> AsyncGenerator[str, None]:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            while inputs:
-                params = {
-                    "inputs": inputs,
-                    "stream": True,
-                }
-                inputs = None
-                async with client.stream(
-                    "POST",
-                    f"{self.parameters.url}/models/{self.parameters.model}",
-                    json=params,
-                    headers={
-                        "Authorization": f"Bearer {self.get_key()}",
-                    },
-                ) as response:
-                    if response.status_code == 200:
-                        async for line in response.aiter_lines():
-                            if line.startswith("data:"):
-                                data = line.removeprefix("data:").strip()
-                                j = json.loads(data)
-                                token = j.get("token", {})
-                                inputs = j.get("generated_text", inputs)
-                                if token.get("id") == self.parameters.stop_token_id:
-                                    return
-                                yield token.get("text", "")
-                    else:
-                        yield f"\nFailed with {response=!r}"
-                        return
+        client = async_client(self.parameters.url)
+        while inputs:
+            params = {
+                "inputs": inputs,
+                "stream": True,
+            }
+            inputs = None
+            async with client.stream(
+                "POST",
+                f"{self.parameters.url}/models/{self.parameters.model}",
+                timeout=timeout,
+                json=params,
+                headers={
+                    "Authorization": f"Bearer {self.get_key()}",
+                },
+            ) as response:
+                if response.status_code == 200:
+                    async for _, j in aiter_json(response.aiter_bytes()):
+                        token = j.get("token", {})
+                        inputs = j.get("generated_text", inputs)
+                        if token.get("id") == self.parameters.stop_token_id:
+                            return
+                        yield token.get("text", "")
+                else:
+                    yield f"\nFailed with {response=!r}"
+                    return
 
     async def aask(
         self,
         session: Session,
         query: str,
         *,
-        max_query_size: int = 5,
         timeout: float = 180,
     ) -> AsyncGenerator[str, None]:
+        user = User(query)
         new_content: list[str] = []
-        inputs = self.make_full_query(session + [User(query)], max_query_size)
+        inputs = await in_thread(
+            self.window, lambda: self.make_full_query(session + [user])
+        )
         try:
             async for content in self.chained_query(inputs, timeout=timeout):
                 if not new_content:
@@ -109,7 +145,8 @@ A dialog, where USER interacts with AI. AI is helpful, kind, obedient, honest, a
             new_content.append(content)
             yield content
 
-        session.extend([User(query), Assistant("".join(new_content))])
+        session.extend([user, Assistant("".join(new_content))])
+        await in_thread(self.window, lambda: self.window.count_response(session[-1]))
 
 
 def factory() -> Backend:
@@ -2,14 +2,22 @@
 #
 # SPDX-License-Identifier: MIT
 
-import json
+import zlib
 from dataclasses import dataclass
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Optional
 
 import httpx
 
+from ..clients import async_client
 from ..core import AutoAskMixin, Backend
-from ..session import Assistant, Role, Session, User
+from ..fragments import FragmentCache
+from ..session import Assistant, Message, Role, Session, User
+from ..sse import aiter_json
+from ..tokens import TokenWindow, Tokenizer, fit_history, get_tokenizer, in_thread
+
+
+# The counts from the last message of a response to keep in usage
+usage_keys = {"tokens_evaluated", "tokens_cached", "prompt_n", "predicted_n"}
 
 
 class LlamaCpp(AutoAskMixin):
@@ -29,75 +37,194 @@ class LlamaCpp(AutoAskMixin):
         end_prompt: str = "<|start_header_id|>assistant<|end_header_id|>\n\n"
         stop: str | None = None
 
+        max_request_tokens: int = 3072
+        """The approximate greatest number of tokens to send in a request. This should be the server's context size, less room for the response. When the session is long, the system prompt and the most recent messages that fit are sent."""
+
+        tokenizer: str = "llama.cpp"
+        """How to count tokens: 'llama.cpp' (with the server's own tokenizer), 'chars' (estimated as 4 characters per token, or e.g., 'chars:3.5'), or 'tiktoken:ENCODING'"""
+
+        trim_chunk: float = 0
+        """The fraction of max_request_tokens of old messages to leave out at once when the session is too long, so that cached prompts stay usable (0: as few as possible)"""
+
+        relevant_history: bool = False
+        """When the session is too long, fill half of each request with the earlier exchanges that best match the question, instead of only recent messages"""
+
+        cache_prompt: bool = True
+        """Ask the server to keep each prompt in its slot's cache, so that it only evaluates the part of the next prompt that differs"""
+
+        slots: int = 1
+        """The number of slots the server has (its --parallel option). With more than 1, each session is pinned to one of them, so that other sessions don't replace its cached prompt."""
+
+        id_slot: int = -1
+        """The server slot to use for every request, or -1 to choose one per session (see slots)"""
+
+        keep_system: bool = True
+        """Keep the system prompt (by setting n_keep) when the server has to shift its context to make room"""
+
+        prewarm: bool = False
+        """Have the server evaluate the session's prompt when the tui starts, so that the first response starts sooner"""
+
     def __init__(self) -> None:
         super().__init__()
         self.parameters = self.Parameters()
+        self.window = TokenWindow()
+        self.fragments = FragmentCache(self.format_message)
+        # The first messages of the session pinned to a slot, and the slot
+        self.pinned: Optional[tuple[Session, int]] = None
+        # The last system prompt sent, as formatted, and its tokens
+        self.system_tokens = ("", 0)
+        # The token counts and timings the server reported for the last
+        # response, including how many tokens of the prompt it had cached
+        self.usage: dict[str, int] = {}
 
     system_message = """\
 A dialog, where USER interacts with AI. AI is helpful, kind, obedient, honest, and knows its own limits.
 """
 
-    def make_full_query(self, messages: Session, max_query_size: int) -> str:
-        del messages[1:-max_query_size]
-        result = [self.parameters.start_prompt]
-        formats = {
+    def get_tokenizer(self) -> Tokenizer:
+        return get_tokenizer(self.parameters.tokenizer, url=self.parameters.url)
+
+    def formats(self) -> dict[str, str]:
+        return {
             Role.SYSTEM: self.parameters.system_format,
             Role.USER: self.parameters.user_format,
             Role.ASSISTANT: self.parameters.assistant_format,
         }
-        for m in messages:
-            content = (m.content or "").strip()
-            if not content:
-                continue
-            result.append(formats[m.role].format(content))
-        full_query = "".join(result)
-        return full_query
+
+    def format_message(self, message: Message) -> str:
+        content = (message.content or "").strip()
+        if not content:
+            return ""
+        if message.role == Role.SYSTEM:
+            return self.parameters.system_format.format(content)
+        elif message.role == Role.ASSISTANT:
+            return self.parameters.assistant_format.format(content)
+        return self.parameters.user_format.format(content)
+
+    def make_full_query(self, messages: Session) -> str:
+        formats = self.formats()
+        tokenizer = self.get_tokenizer()
+        messages = fit_history(
+            self.window,
+            tokenizer,
+            messages,
+            self.parameters.max_request_tokens,
+            max(tokenizer.count(f.format("")) for f in formats.values()),
+            tokenizer.count(self.parameters.start_prompt + self.parameters.end_prompt),
+            chunk=self.parameters.trim_chunk,
+            relevant=self.parameters.relevant_history,
+        )
+        return self.parameters.start_prompt + self.fragments.join(messages)
+
+    def slot(self, messages: Session) -> int:
+        if self.parameters.id_slot >= 0 or self.parameters.slots <= 1:
+            return self.parameters.id_slot
+        # The first request pins its session to a slot, chosen from the
+        # session's first two messages, which don't change as it grows, so
+        # later processes continuing the session choose the same one (unless
+        # it was prewarmed in the tui while it only had its system message).
+        # Later requests that start with the same message objects continue
+        # the session and go to that slot. Other requests, like summaries
+        # and the parts of a chunked ask, start differently; they go to
+        # whichever slot the server chooses, so that they don't replace the
+        # session's cached prompt or wait for each other.
+        if self.pinned is None:
+            key = "\0".join(m.content for m in messages[:2])
+            slot = zlib.crc32(key.encode("utf-8")) % self.parameters.slots
+            self.pinned = (messages[:2], slot)
+        start, slot = self.pinned
+        if len(messages) < len(start) or any(
+            a is not b for a, b in zip(start, messages)
+        ):
+            return -1
+        return slot
+
+    def make_request(self, messages: Session, **fields: Any) -> dict[str, Any]:
+        params: dict[str, Any] = {
+            "prompt": self.make_full_query(messages),
+            "cache_prompt": self.parameters.cache_prompt,
+            **fields,
+        }
+        slot = self.slot(messages)
+        if slot >= 0:
+            params["id_slot"] = slot
+        if self.parameters.keep_system and messages[0].role == Role.SYSTEM:
+            system = self.parameters.start_prompt + self.format_message(messages[0])
+            if system != self.system_tokens[0]:
+                self.system_tokens = (system, self.get_tokenizer().count(system))
+            params["n_keep"] = self.system_tokens[1]
+        return params
+
+    async def aprewarm(self, session: Session, *, timeout: float = 180) -> None:
+        """If enabled, have the server evaluate the prompt of session into its
+        cache, so that a request continuing it only evaluates the question"""
+        if not self.parameters.prewarm or not session:
+            return
+        params = await in_thread(
+            self.window, lambda: self.make_request(session, n_predict=0)
+        )
+        try:
+            client = async_client(self.parameters.url)
+            await client.post(self.parameters.url, json=params, timeout=timeout)
+        except httpx.HTTPError:
+            # The request that follows works just the same, only slower
+            pass
 
     async def aask(
         self,
         session: Session,
         query: str,
         *,
-        max_query_size: int = 5,
         timeout: float = 180,
     ) -> AsyncGenerator[str, None]:
-        params = {
-            "prompt": self.make_full_query(session + [User(query)], max_query_size),
-            "stream": True,
-            "stop": ["</s>", "<s>", "[INST]", "<|eot_id|>"],
-        }
+        user = User(query)
+        params = await in_thread(
+            self.window,
+            lambda: self.make_request(
+                session + [user],
+                stream=True,
+                stop=["</s>", "<s>", "[INST]", "<|eot_id|>"],
+            ),
+        )
+        self.usage = {}
         new_content: list[str] = []
         try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                async with client.stream(
-                    "POST",
-                    self.parameters.url,
-                    json=params,
-                ) as response:
-                    if response.status_code == 200:
-                        async for line in response.aiter_lines():
-                            if line.startswith("data:"):
-                                data = line.removeprefix("data:").strip()
-                                j = json.loads(data)
-                                content = j.get("content")
-                                if not new_content:
-                                    content = content.lstrip()
-                                if content:
-                                    new_content.append(content)
-                                    yield content
-                                if j.get("stop"):
-                                    break
-                    else:
-                        content = f"\nFailed with {response=!r}"
-                        new_content.append(content)
-                        yield content
+            client = async_client(self.parameters.url)
+            async with client.stream(
+                "POST",
+                self.parameters.url,
+                timeout=timeout,
+                json=params,
+            ) as response:
+                if response.status_code == 200:
+                    async for _, j in aiter_json(response.aiter_bytes()):
+                        content = j.get("content")
+                        if not new_content:
+                            content = content.lstrip()
+                        if content:
+                            new_content.append(content)
+                            yield content
+                        if j.get("stop"):
+                            self.usage = {
+                                k: v
+                                for k, v in [
+                                    *j.items(),
+                                    *j.get("timings", {}).items(),
+                                ]
+                                if k in usage_keys
+                            }
+                else:
+                    content = f"\nFailed with {response=!r}"
+                    new_content.append(content)
+                    yield content
 
         except httpx.HTTPError as e:
             content = f"\nException: {e!r}"
             new_content.append(content)
             yield content
 
-        session.extend([User(query), Assistant("".join(new_content))])
+        session.extend([user, Assistant("".join(new_content))])
+        await in_thread(self.window, lambda: self.window.count_response(session[-1]))
 
 
 def factory() -> Backend:
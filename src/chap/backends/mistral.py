@@ -2,15 +2,25 @@
 #
 # SPDX-License-Identifier: MIT
 
-import json
 from dataclasses import dataclass
-from typing import AsyncGenerator, Any
+from typing import AsyncGenerator
 
 import httpx
 
+from ..clients import async_client
 from ..core import AutoAskMixin
+from ..fragments import FragmentCache, json_request_body, message_json
 from ..key import UsesKeyMixin
 from ..session import Assistant, Session, User
+from ..sse import aiter_json
+from ..tokens import (
+    TokenWindow,
+    Tokenizer,
+    chat_message_tokens,
+    fit_history,
+    get_tokenizer,
+    in_thread,
+)
 
 
 class Mistral(AutoAskMixin, UsesKeyMixin):
@@ -21,76 +31,101 @@ class Mistral(AutoAskMixin, UsesKeyMixin):
         max_new_tokens: int = 1000
         api_key_name = "mistral_api_key"
 
+        max_request_tokens: int = 8192
+        """The approximate greatest number of tokens to send in a request. When the session is long, the system prompt and the most recent messages that fit are sent."""
+
+        tokenizer: str = "chars"
+        """How to count tokens: 'chars' (estimated as 4 characters per token, or e.g., 'chars:3.5'), 'tiktoken:ENCODING', or 'llama.cpp:URL'"""
+
+        trim_chunk: float = 0
+        """The fraction of max_request_tokens of old messages to leave out at once when the session is too long, so that cached prompts stay usable (0: as few as possible)"""
+
+        relevant_history: bool = False
+        """When the session is too long, fill half of each request with the earlier exchanges that best match the question, instead of only recent messages"""
+
     def __init__(self) -> None:
         super().__init__()
         self.parameters = self.Parameters()
+        self.window = TokenWindow()
+        self.fragments = FragmentCache(message_json, ", ")
 
     system_message = """\
 Answer each question accurately and thoroughly.
 """
 
-    def make_full_query(self, messages: Session, max_query_size: int) -> dict[str, Any]:
-        messages = [m for m in messages if m.content]
-        del messages[1:-max_query_size]
-        result = dict(
-            model=self.parameters.model,
-            max_tokens=self.parameters.max_new_tokens,
-            messages=[dict(role=str(m.role), content=m.content) for m in messages],
-            stream=True,
+    def get_tokenizer(self) -> Tokenizer:
+        return get_tokenizer(self.parameters.tokenizer)
+
+    def make_full_query(self, messages: Session) -> bytes:
+        messages = fit_history(
+            self.window,
+            self.get_tokenizer(),
+            [m for m in messages if m.content],
+            self.parameters.max_request_tokens,
+            chat_message_tokens,
+            chunk=self.parameters.trim_chunk,
+            relevant=self.parameters.relevant_history,
+        )
+        return json_request_body(
+            dict(
+                model=self.parameters.model,
+                max_tokens=self.parameters.max_new_tokens,
+                stream=True,
+            ),
+            messages,
+            self.fragments,
         )
-        return result
 
     async def aask(
         self,
         session: Session,
         query: str,
         *,
-        max_query_size: int = 5,
         timeout: float = 180,
     ) -> AsyncGenerator[str, None]:
+        user = User(query)
         new_content: list[str] = []
-        params = self.make_full_query(session + [User(query)], max_query_size)
+        body = await in_thread(
+            self.window, lambda: self.make_full_query(session + [user])
+        )
         try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                async with client.stream(
-                    "POST",
-                    f"{self.parameters.url}/v1/chat/completions",
-                    json=params,
-                    headers={
-                        "Authorization": f"Bearer {self.get_key()}",
-                        "content-type": "application/json",
-                        "accept": "application/json",
-                        "model": "application/json",
-                    },
-                ) as response:
-                    if response.status_code == 200:
-                        async for line in response.aiter_lines():
-                            if line.startswith("data:"):
-                                data = line.removeprefix("data:").strip()
-                                if data == "[DONE]":
-                                    break
-                                j = json.loads(data)
-                                content = (
-                                    j.get("choices", [{}])[0]
-                                    .get("delta", {})
-                                    .get("content", "")
-                                )
-                                if content:
-                                    new_content.append(content)
-                                    yield content
-                    else:
-                        content = f"\nFailed with {response=!r}"
-                        new_content.append(content)
-                        yield content
-                        async for line in response.aiter_lines():
-                            new_content.append(line)
-                            yield line
+            client = async_client(self.parameters.url)
+            async with client.stream(
+                "POST",
+                f"{self.parameters.url}/v1/chat/completions",
+                timeout=timeout,
+                content=body,
+                headers={
+                    "Authorization": f"Bearer {self.get_key()}",
+                    "content-type": "application/json",
+                    "accept": "application/json",
+                    "model": "application/json",
+                },
+            ) as response:
+                if response.status_code == 200:
+                    async for _, j in aiter_json(response.aiter_bytes()):
+                        content = (
+                            j.get("choices", [{}])[0]
+                            .get("delta", {})
+                            .get("content", "")
+                        )
+                        if content:
+                            new_content.append(content)
+                            yield content
+                else:
+                    content = f"\nFailed with {response=!r}"
+                    new_content.append(content)
+                    yield content
+                    async for line in response.aiter_lines():
+                        new_content.append(line)
+                        yield line
         except httpx.HTTPError as e:
             content = f"\nException: {e!r}"
             new_content.append(content)
             yield content
 
-        session.extend([User(query), Assistant("".join(new_content))])
+        session.extend([user, Assistant("".join(new_content))])
+        await in_thread(self.window, lambda: self.window.count_response(session[-1]))
 
 
 factory = Mistral
@@ -4,52 +4,33 @@
 
 import functools
 import json
-import warnings
 from dataclasses import dataclass
 from typing import AsyncGenerator, cast
 
 import httpx
-import tiktoken
 
+from ..clients import async_client, sync_client
 from ..core import Backend
+from ..fragments import FragmentCache, json_request_body, message_json
 from ..key import UsesKeyMixin
-from ..session import Assistant, Message, Session, User, session_to_list
+from ..session import Assistant, Session, User
+from ..sse import aiter_json
+from ..tokens import TokenWindow, Tokenizer, fit_history, get_tokenizer, in_thread
 
 
 @dataclass(frozen=True)
 class EncodingMeta:
-    encoding: tiktoken.Encoding
     tokens_per_message: int
     tokens_per_name: int
     tokens_overhead: int
 
-    @functools.lru_cache()
-    def encode(self, s: str) -> list[int]:
-        return self.encoding.encode(s)
-
-    def num_tokens_for_message(self, message: Message) -> int:
-        # n.b. chap doesn't use message.name yet
-        return (
-            len(self.encode(message.role))
-            + len(self.encode(message.content))
-            + self.tokens_per_message
-        )
-
-    def num_tokens_for_messages(self, messages: Session) -> int:
-        return (
-            sum(self.num_tokens_for_message(message) for message in messages)
-            + self.tokens_overhead
-        )
+    # The role is a single token in every encoding, and
+    # n.b. chap doesn't use message.name yet
+    tokens_per_role = 1
 
     @classmethod
     @functools.cache
     def from_model(cls, model: str) -> "EncodingMeta":
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            warnings.warn("Warning: model not found. Using cl100k_base encoding.")
-            encoding = tiktoken.get_encoding("cl100k_base")
-
         tokens_per_message = 3
         tokens_per_name = 1
         tokens_overhead = 3
@@ -60,7 +41,7 @@ class EncodingMeta:
             )
             tokens_per_name = -1  # if there's a name, the role is omitted
 
-        return cls(encoding, tokens_per_message, tokens_per_name, tokens_overhead)
+        return cls(tokens_per_message, tokens_per_name, tokens_overhead)
 
 
 class ChatGPT(UsesKeyMixin):
@@ -72,6 +53,15 @@ class ChatGPT(UsesKeyMixin):
         max_request_tokens: int = 1024
         """The approximate greatest number of tokens to send in a request. When the session is long, the system prompt and 1 or more of the most recent interaction steps are sent."""
 
+        tokenizer: str = "tiktoken"
+        """How to count tokens: 'tiktoken' (with the model's encoding, or e.g., 'tiktoken:o200k_base'), 'llama.cpp:URL', or 'chars' (estimated as 4 characters per token, or e.g., 'chars:3.5')"""
+
+        trim_chunk: float = 0
+        """The fraction of max_request_tokens of old messages to leave out at once when the session is too long, so that cached prompts stay usable (0: as few as possible)"""
+
+        relevant_history: bool = False
+        """When the session is too long, fill half of each request with the earlier exchanges that best match the question, instead of only recent messages"""
+
         url: str = "https://api.openai.com/v1/chat/completions"
         """The URL of a chatgpt-compatible server's completion endpoint. Notably, llama.cpp's server is compatible with this backend, and can automatically apply common chat templates too."""
 
@@ -88,36 +78,38 @@ class ChatGPT(UsesKeyMixin):
 
     def __init__(self) -> None:
         self.parameters = self.Parameters()
+        self.window = TokenWindow()
+        self.fragments = FragmentCache(message_json, ", ")
 
     system_message: str = "You're named Chap (they/them). Chap strives to answer truthfully and frankly. You have opinions, preferences, and emotions, you can say when you don't know, and you prefer to speak in plain language."
 
+    def get_tokenizer(self) -> Tokenizer:
+        return get_tokenizer(self.parameters.tokenizer, model=self.parameters.model)
+
     def make_full_prompt(self, all_history: Session) -> Session:
         encoding = EncodingMeta.from_model(self.parameters.model)
-        result = [all_history[0]]  # Assumed to be system prompt
-        left = self.parameters.max_request_tokens - encoding.num_tokens_for_messages(
-            result
+        return fit_history(
+            self.window,
+            self.get_tokenizer(),
+            all_history,
+            self.parameters.max_request_tokens,
+            encoding.tokens_per_message + encoding.tokens_per_role,
+            encoding.tokens_overhead,
+            chunk=self.parameters.trim_chunk,
+            relevant=self.parameters.relevant_history,
         )
-        parts = []
-        for message in reversed(all_history[1:]):
-            msglen = encoding.num_tokens_for_message(message)
-            if left >= msglen:
-                left -= msglen
-                parts.append(message)
-            else:
-                break
-        result.extend(reversed(parts))
-        return result
 
     def ask(self, session: Session, query: str, *, timeout: float = 60) -> str:
-        full_prompt = self.make_full_prompt(session + [User(query)])
-        response = httpx.post(
+        user = User(query)
+        full_prompt = self.make_full_prompt(session + [user])
+        response = sync_client(self.parameters.url).post(
             self.parameters.url,
-            json={
-                "model": self.parameters.model,
-                "messages": session_to_list(full_prompt),
-            },
+            content=json_request_body(
+                {"model": self.parameters.model}, full_prompt, self.fragments
+            ),
             headers={
                 "Authorization": f"Bearer {self.get_key()}",
+                "content-type": "application/json",
             },
             timeout=timeout,
         )
@@ -130,51 +122,60 @@ class ChatGPT(UsesKeyMixin):
         except (KeyError, IndexError, json.decoder.JSONDecodeError):
             return f"Failure {response.text} ({response.status_code})"
 
-        session.extend([User(query), Assistant(result)])
+        session.extend([user, Assistant(result)])
+        self.window.count_response(session[-1])
         return result
 
     async def aask(
         self, session: Session, query: str, *, timeout: float = 60
     ) -> AsyncGenerator[str, None]:
-        full_prompt = self.make_full_prompt(session + [User(query)])
+        user = User(query)
+
+        def make_body() -> bytes:
+            return json_request_body(
+                {
+                    "model": self.parameters.model,
+                    "temperature": self.parameters.temperature,
+                    "top_p": self.parameters.top_p,
+                    "stream": True,
+                },
+                self.make_full_prompt(session + [user]),
+                self.fragments,
+            )
+
+        body = await in_thread(self.window, make_body)
         new_content = []
         try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                async with client.stream(
-                    "POST",
-                    self.parameters.url,
-                    headers={"authorization": f"Bearer {self.get_key()}"},
-                    json={
-                        "model": self.parameters.model,
-                        "temperature": self.parameters.temperature,
-                        "top_p": self.parameters.top_p,
-                        "stream": True,
-                        "messages": session_to_list(full_prompt),
-                    },
-                ) as response:
-                    if response.status_code == 200:
-                        async for line in response.aiter_lines():
-                            if line.startswith("data:"):
-                                data = line.removeprefix("data:").strip()
-                                if data == "[DONE]":
-                                    break
-                                j = json.loads(data)
-                                delta = j["choices"][0]["delta"]
-                                content = delta.get("content")
-                                if content:
-                                    new_content.append(content)
-                                    yield content
-                    else:
-                        content = f"\nFailed with {response=!r}"
-                        new_content.append(content)
-                        yield content
+            client = async_client(self.parameters.url)
+            async with client.stream(
+                "POST",
+                self.parameters.url,
+                timeout=timeout,
+                headers={
+                    "authorization": f"Bearer {self.get_key()}",
+                    "content-type": "application/json",
+                },
+                content=body,
+            ) as response:
+                if response.status_code == 200:
+                    async for _, j in aiter_json(response.aiter_bytes()):
+                        delta = j["choices"][0]["delta"]
+                        content = delta.get("content")
+                        if content:
+                            new_content.append(content)
+                            yield content
+                else:
+                    content = f"\nFailed with {response=!r}"
+                    new_content.append(content)
+                    yield content
 
         except httpx.HTTPError as e:
             content = f"\nException: {e!r}"
             new_content.append(content)
             yield content
 
-        session.extend([User(query), Assistant("".join(new_content))])
+        session.extend([user, Assistant("".join(new_content))])
+        await in_thread(self.window, lambda: self.window.count_response(session[-1]))
 
 
 def factory() -> Backend:
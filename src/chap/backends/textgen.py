@@ -10,7 +10,9 @@ from typing import AsyncGenerator
 import websockets
 
 from ..core import AutoAskMixin, Backend
-from ..session import Assistant, Role, Session, User
+from ..fragments import FragmentCache
+from ..session import Assistant, Message, Role, Session, User
+from ..tokens import TokenWindow, Tokenizer, fit_history, get_tokenizer, in_thread
 
 
 class Textgen(AutoAskMixin):
@@ -18,9 +20,23 @@ class Textgen(AutoAskMixin):
     class Parameters:
         server_hostname: str = "localhost"
 
+        max_request_tokens: int = 1536
+        """The approximate greatest number of tokens to send in a request. When the session is long, the system prompt and the most recent messages that fit are sent."""
+
+        tokenizer: str = "chars"
+        """How to count tokens: 'chars' (estimated as 4 characters per token, or e.g., 'chars:3.5'), 'tiktoken:ENCODING', or 'llama.cpp:URL'"""
+
+        trim_chunk: float = 0
+        """The fraction of max_request_tokens of old messages to leave out at once when the session is too long, so that cached prompts stay usable (0: as few as possible)"""
+
+        relevant_history: bool = False
+        """When the session is too long, fill half of each request with the earlier exchanges that best match the question, instead of only recent messages"""
+
     def __init__(self) -> None:
         super().__init__()
         self.parameters = self.Parameters()
+        self.window = TokenWindow()
+        self.fragments = FragmentCache(self.format_message, "\n")
 
     system_message = """\
 A dialog, where USER interacts with AI. AI is helpful, kind, obedient, honest, and knows its own limits.
@@ -29,12 +45,22 @@ USER: Hello, AI.
 
 AI: Hello! How can I assist you today?"""
 
+    role_map = {
+        Role.USER: "USER: ",
+        Role.ASSISTANT: "AI: ",
+    }
+
+    def get_tokenizer(self) -> Tokenizer:
+        return get_tokenizer(self.parameters.tokenizer)
+
+    def format_message(self, message: Message) -> str:
+        return f"{self.role_map.get(message.role, '')}{message.content}\n"
+
     async def aask(
         self,
         session: Session,
         query: str,
         *,
-        max_query_size: int = 5,
         timeout: float = 60,
     ) -> AsyncGenerator[str, None]:
         params = {
@@ -54,15 +80,23 @@ AI: Hello! How can I assist you today?"""
         }
         session_hash = str(uuid.uuid4())
 
-        role_map = {
-            Role.USER: "USER: ",
-            Role.ASSISTANT: "AI: ",
-        }
-        full_prompt = session + [User(query)]
-        del full_prompt[1:-max_query_size]
-        new_data = old_data = full_query = "\n".join(
-            f"{role_map.get(q.role,'')}{q.content}\n" for q in full_prompt
-        ) + f"\n{role_map.get('assistant')}"
+        role_map = self.role_map
+        user = User(query)
+
+        def make_full_query() -> str:
+            tokenizer = self.get_tokenizer()
+            full_prompt = fit_history(
+                self.window,
+                tokenizer,
+                session + [user],
+                self.parameters.max_request_tokens,
+                max(tokenizer.count(f"{prefix}\n\n") for prefix in role_map.values()),
+                chunk=self.parameters.trim_chunk,
+                relevant=self.parameters.relevant_history,
+            )
+            return self.fragments.join(full_prompt) + f"\n{role_map.get('assistant')}"
+
+        new_data = old_data = full_query = await in_thread(self.window, make_full_query)
         try:
             async with websockets.connect(
                 f"ws://{self.parameters.server_hostname}:7860/queue/join"
@@ -132,7 +166,8 @@ AI: Hello! How can I assist you today?"""
             yield content
 
         all_response = new_data[len(full_query) :]
-        session.extend([User(query), Assistant(all_response)])
+        session.extend([user, Assistant(all_response)])
+        await in_thread(self.window, lambda: self.window.count_response(session[-1]))
 
 
 def factory() -> Backend:
@@ -0,0 +1,118 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import asyncio
+import atexit
+import importlib.util
+import warnings
+import weakref
+from typing import Any, Coroutine, TypeVar
+
+import httpx
+
+# Requests share one HTTP client per server (scheme, host and port), so a
+# connection made for one request is kept open and used again by the next:
+# the turns of a tui session, or the many requests of `ask --chunk-tokens`,
+# only set up a connection (and TLS) once. An asyncio client's connections
+# belong to the event loop that opened them, so async clients are kept per
+# loop, and `run` closes them before its loop ends; the synchronous clients
+# are closed when the program exits.
+
+T = TypeVar("T")
+
+http2 = False
+limits = httpx.Limits(
+    max_connections=20, max_keepalive_connections=20, keepalive_expiry=300
+)
+
+_clients: dict[str, httpx.Client] = {}
+_async_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, httpx.AsyncClient]
+] = weakref.WeakKeyDictionary()
+
+
+def configure(
+    *,
+    use_http2: bool | None = None,
+    max_connections: int | None = None,
+    keepalive_expiry: float | None = None,
+) -> None:
+    """Change the settings of clients created from now on
+
+    use_http2 is only honored if the h2 package is installed. Each client
+    opens at most max_connections connections, and closes them after
+    keepalive_expiry seconds unused."""
+    global http2, limits
+    if use_http2 is not None:
+        http2 = use_http2
+    limits = httpx.Limits(
+        max_connections=max_connections or limits.max_connections,
+        max_keepalive_connections=max_connections or limits.max_keepalive_connections,
+        keepalive_expiry=(
+            limits.keepalive_expiry if keepalive_expiry is None else keepalive_expiry
+        ),
+    )
+
+
+def _origin(url: str) -> str:
+    u = httpx.URL(url)
+    return f"{u.scheme}://{u.netloc.decode('ascii')}"
+
+
+def _settings() -> dict[str, Any]:
+    global http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        warnings.warn("HTTP/2 needs the h2 package (pip install httpx[http2])")
+        http2 = False
+    return {"http2": http2, "limits": limits, "timeout": 60}
+
+
+def sync_client(url: str) -> httpx.Client:
+    """Return the shared client for url's server"""
+    origin = _origin(url)
+    result = _clients.get(origin)
+    if result is None:
+        result = _clients[origin] = httpx.Client(**_settings())
+    return result
+
+
+def async_client(url: str) -> httpx.AsyncClient:
+    """Return the shared asyncio client for url's server, for the running
+    event loop"""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    origin = _origin(url)
+    result = clients.get(origin)
+    if result is None:
+        result = clients[origin] = httpx.AsyncClient(**_settings())
+    return result
+
+
+async def aclose_clients() -> None:
+    """Close the running event loop's clients"""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for c in clients.values():
+        await c.aclose()
+
+
+@atexit.register
+def close_clients() -> None:
+    """Close the synchronous clients"""
+    for c in _clients.values():
+        c.close()
+    _clients.clear()
+
+
+def run(main: Coroutine[Any, Any, T]) -> T:
+    """Like asyncio.run, but closing the clients used by main before the
+    event loop ends"""
+
+    async def wrapper() -> T:
+        try:
+            return await main
+        finally:
+            await aclose_clients()
+
+    return asyncio.run(wrapper())
@@ -2,15 +2,18 @@
 #
 # SPDX-License-Identifier: MIT
 
-import asyncio
 import sys
 from typing import Iterable, Optional, Protocol
 
 import click
 import rich
 
+from ..clients import run
 from ..core import Backend, Obj, command_uses_new_session
-from ..session import Session, session_to_file
+from ..mapreduce import PartFailed, map_reduce, split_input
+from ..session import Assistant, Session, User
+from ..summary import summarized_view, update_summary
+from ..tokens import CharTokenizer, Tokenizer, TokenWindow
 
 bold = "\033[1m"
 nobold = "\033[m"
@@ -73,12 +76,14 @@ class WrappingPrinter:
                 self._sp = ""
 
 
-def verbose_ask(api: Backend, session: Session, q: str, print_prompt: bool) -> str:
-    printer: Printable
+def make_printer() -> Printable:
     if sys.stdout.isatty():
-        printer = WrappingPrinter()
-    else:
-        printer = DumbPrinter()
+        return WrappingPrinter()
+    return DumbPrinter()
+
+
+def verbose_ask(api: Backend, session: Session, q: str, print_prompt: bool) -> str:
+    printer = make_printer()
     tokens: list[str] = []
 
     async def work() -> None:
@@ -92,17 +97,131 @@ def verbose_ask(api: Backend, session: Session, q: str, print_prompt: bool) -> s
         printer.add("\n")
         printer.add("\n")
 
-    asyncio.run(work())
+    run(work())
     printer.add("\n")
     result = "".join(tokens)
     return result
 
 
+def chunked_ask(
+    api: Backend,
+    session: Session,
+    prompt: str,
+    max_tokens: int,
+    jobs: int,
+    print_prompt: bool,
+) -> str:
+    # Backends that count tokens say how; the others are estimated
+    get_tokenizer = getattr(api, "get_tokenizer", None)
+    tokenizer: Tokenizer = (
+        get_tokenizer() if get_tokenizer is not None else CharTokenizer()
+    )
+    printer = make_printer()
+    if print_prompt:
+        printer.raw(bold)
+        printer.add(prompt)
+        printer.raw(nobold)
+        printer.add("\n")
+        printer.add("\n")
+
+    show_progress = sys.stderr.isatty()
+    progress_shown = False
+
+    def progress(done: int, read: int) -> None:
+        nonlocal progress_shown
+        if show_progress:
+            print(f"\rAnswered {done} of {read} parts", end="", file=sys.stderr)
+            progress_shown = True
+
+    def output(token: str) -> None:
+        nonlocal progress_shown
+        if progress_shown:
+            print(file=sys.stderr)
+            progress_shown = False
+        printer.add(token)
+
+    try:
+        result = run(
+            map_reduce(
+                api,
+                session[:1],
+                prompt,
+                split_input(sys.stdin, max_tokens, tokenizer.count),
+                max_tokens,
+                tokenizer.count,
+                jobs,
+                output,
+                progress,
+            )
+        )
+    except PartFailed as e:
+        if progress_shown:
+            print(file=sys.stderr)
+        raise click.ClickException(str(e)) from e
+    printer.add("\n")
+    # The session just records the question and the combined answer
+    session.extend([User(prompt), Assistant(result)])
+    return result
+
+
+def print_cache_reuse(api: Backend) -> None:
+    # Backends that trim long sessions keep a TokenWindow, which records how
+    # much of the request the previous one started with
+    window = getattr(api, "window", None)
+    if not isinstance(window, TokenWindow):
+        return
+    reused, total = window.reuse
+    if total:
+        print(
+            f"Expected prompt cache reuse: {reused} of {total} tokens ({reused / total:.0%})",
+            file=sys.stderr,
+        )
+
+
+def print_usage(api: Backend) -> None:
+    # Backends that can tell how many tokens the server used for the last
+    # response (including any it reused from its prompt cache) keep them in
+    # a usage dict
+    usage = getattr(api, "usage", None)
+    if usage:
+        print(
+            "Server token usage: " + ", ".join(f"{k}={v}" for k, v in usage.items()),
+            file=sys.stderr,
+        )
+
+
 @command_uses_new_session
 @click.option("--print-prompt/--no-print-prompt", default=True)
 @click.option("--stdin/--no-stdin", "use_stdin", default=False)
+@click.option(
+    "--chunk-tokens",
+    type=int,
+    default=0,
+    help="With --stdin, read the input in parts of at most this many tokens, ask the prompt about each part, and then have the backend combine the answers. For input too long for one request; leave room in the backend's max_request_tokens for the prompt.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=4,
+    help="With --chunk-tokens, how many requests to make at once",
+)
+@click.option(
+    "--verbose",
+    "-v",
+    is_flag=True,
+    help="Report how much of the request the server could reuse from its cache of the previous one, and the token usage it reported",
+)
 @click.argument("prompt", nargs=-1)
-def main(obj: Obj, prompt: list[str], use_stdin: bool, print_prompt: bool) -> None:
+def main(
+    obj: Obj,
+    prompt: list[str],
+    use_stdin: bool,
+    chunk_tokens: int,
+    jobs: int,
+    print_prompt: bool,
+    verbose: bool,
+) -> None:
     """Ask a question (command-line argument is passed as prompt)"""
     session = obj.session
     assert session is not None
@@ -113,6 +232,20 @@ def main(obj: Obj, prompt: list[str], use_stdin: bool, print_prompt: bool) -> No
     api = obj.api
     assert api is not None
 
+    if chunk_tokens:
+        if not use_stdin:
+            raise click.UsageError("--chunk-tokens only applies with --stdin")
+        if not prompt:
+            raise click.UsageError(
+                "--chunk-tokens needs a prompt, to ask about each part of the input"
+            )
+        chunked_ask(api, session, " ".join(prompt), chunk_tokens, jobs, print_prompt)
+        if verbose:
+            print_usage(api)
+        print(f"Saving session to {session_filename}", file=sys.stderr)
+        obj.storage.save(session, session_filename)
+        return
+
     if use_stdin:
         if prompt:
             raise click.UsageError("Can't use 'prompt' together with --stdin")
@@ -122,11 +255,22 @@ def main(obj: Obj, prompt: list[str], use_stdin: bool, print_prompt: bool) -> No
         joined_prompt = " ".join(prompt)
     #    symlink_session_filename(session_filename)
 
-    response = verbose_ask(api, session, joined_prompt, print_prompt=print_prompt)
+    # With summaries, the question is asked of the session as summarized,
+    # and the new messages are added to the session itself
+    view = summarized_view(session) if obj.summarize else session
+    old_len = len(view)
+    response = verbose_ask(api, view, joined_prompt, print_prompt=print_prompt)
+    if verbose:
+        print_cache_reuse(api)
+        print_usage(api)
+    if view is not session:
+        session.extend(view[old_len:])
+        if run(update_summary(api, session, session[-1], obj.summarize)):
+            print("Updated the summary of the session", file=sys.stderr)
 
     print(f"Saving session to {session_filename}", file=sys.stderr)
     if response is not None:
-        session_to_file(session, session_filename)
+        obj.storage.save(session, session_filename)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import concurrent.futures
+import os
+import pathlib
+import sys
+from typing import Optional, Tuple
+
+import click
+
+from ..core import conversations_path
+from ..session import (
+    compress_session_file,
+    compression_of,
+    read_recent_manifest,
+    rebuild_recent_manifest,
+    session_files,
+)
+
+
+def compress_one(
+    path: pathlib.Path, compression: str
+) -> Tuple[pathlib.Path, int, int, Optional[str]]:
+    """Compress one session, returning its new path, the old and new sizes,
+    and an error message if it failed"""
+    try:
+        old_size = path.stat().st_size
+        new_path = compress_session_file(path, compression)
+        return new_path, old_size, new_path.stat().st_size, None
+    except Exception as e:
+        return path, 0, 0, f"Failed to compress {path}: {e}"
+
+
+@click.command
+@click.option(
+    "--format",
+    "compression",
+    type=click.Choice(["gz", "zst"]),
+    default="gz",
+    help="The compression to use ('zst' requires the zstandard package)",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Compress sessions in this many processes (0: one per CPU)",
+)
+@click.option(
+    "--directory",
+    "-d",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default=conversations_path,
+)
+def main(compression: str, jobs: int, directory: pathlib.Path) -> None:
+    """Compress all uncompressed sessions
+
+    Compressed sessions are read transparently by all other commands. To
+    compress new sessions as well, use the '--session-format' option."""
+    paths = [p for p in session_files(directory) if not compression_of(p)]
+    if not paths:
+        return
+
+    suffix = f".{compression}"
+    total_old = total_new = count = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs or os.cpu_count() or 1
+    ) as executor:
+        for new_path, old_size, new_size, error in executor.map(
+            compress_one, paths, [suffix] * len(paths), chunksize=16
+        ):
+            if error is not None:
+                print(error, file=sys.stderr)
+                continue
+            count += 1
+            total_old += old_size
+            total_new += new_size
+
+    if read_recent_manifest(directory, check_fresh=False) is not None:
+        rebuild_recent_manifest(directory)
+
+    print(
+        f"Compressed {count} sessions from {total_old} to {total_new} bytes",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
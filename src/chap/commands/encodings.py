@@ -0,0 +1,71 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import hashlib
+import pathlib
+import sys
+
+import click
+
+from ..tokens import (
+    TiktokenTokenizer,
+    seed_tiktoken_cache,
+    tiktoken_cache_dir,
+    tiktoken_url,
+)
+
+# The encodings that are each loaded from a single file (others, such as
+# p50k_edit, reuse one of these)
+encoding_names = ["r50k_base", "p50k_base", "cl100k_base", "o200k_base"]
+
+
+@click.command
+@click.option(
+    "--check/--no-check",
+    default=True,
+    help="Load each encoding after adding it, to check that it is the file tiktoken expects",
+)
+@click.argument(
+    "files",
+    nargs=-1,
+    type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path),
+)
+def main(check: bool, files: list[pathlib.Path]) -> None:
+    """Add tiktoken encodings to the cache, for use without network access
+
+    Each FILE is an encoding as published by OpenAI, named for the encoding
+    (e.g., o200k_base.tiktoken). Without FILEs, show which encodings are
+    cached.
+
+    Alternatively, point TIKTOKEN_CACHE_DIR at a copy of a cache filled on a
+    machine with network access."""
+
+    cache_dir = tiktoken_cache_dir()
+    if not files:
+        print(f"Cache: {cache_dir or '(disabled)'}")
+        for name in encoding_names:
+            key = hashlib.sha1(tiktoken_url.format(name).encode()).hexdigest()
+            cached = cache_dir is not None and (cache_dir / key).exists()
+            print(f"{name}: {'cached' if cached else 'not cached'}")
+        return
+
+    failed = False
+    for path in files:
+        name = seed_tiktoken_cache(path)
+        if check:
+            try:
+                TiktokenTokenizer(name).encoding
+            except Exception as e:
+                print(f"{path} can't be used as {name}: {e}", file=sys.stderr)
+                failed = True
+                continue
+        print(f"{path} -> {name}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
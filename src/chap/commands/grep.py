@@ -12,35 +12,57 @@ from typing import Iterable, Optional, Tuple
 import click
 import rich
 
-from ..core import conversations_path as default_conversations_path
-from ..session import Message, session_from_file
+from ..core import Obj, conversations_path as default_conversations_path
+from ..search import SearchIndex, fts5_available
+from ..session import Message, all_session_paths
+from ..storage import FileStorage, StorageEngine
 from .render import to_markdown
 
 
 def list_files_matching_rx(
-    rx: re.Pattern[str], conversations_path: Optional[pathlib.Path] = None
+    rx: re.Pattern[str],
+    conversations_path: Optional[pathlib.Path] = None,
+    jobs: int = 1,
+    first_only: bool = False,
+    storage: Optional[StorageEngine] = None,
 ) -> Iterable[Tuple[pathlib.Path, Message]]:
-    for conversation in (conversations_path or default_conversations_path).glob(
-        "*.json"
-    ):
-        try:
-            session = session_from_file(conversation)
-        except Exception as e:
-            print(f"Failed to read {conversation}: {e}", file=sys.stderr)
-            continue
-
-        for message in session:
-            if isinstance(message.content, str) and rx.search(message.content):
-                yield conversation, message
+    return (storage or FileStorage()).search(
+        conversations_path or default_conversations_path, rx, jobs, first_only
+    )
 
 
 @click.command
+@click.pass_obj
 @click.option("--ignore-case", "-i", is_flag=True)
 @click.option("--files-with-matches", "-l", is_flag=True)
 @click.option("--fixed-strings", "--literal", "-F", is_flag=True)
+@click.option(
+    "--index/--no-index",
+    "use_index",
+    default=False,
+    envvar="CHAP_GREP_INDEX",
+    help="Use (and update) a persistent full text index of all sessions",
+)
+@click.option("--reindex", is_flag=True, help="Rebuild the index from scratch")
+@click.option("--stats", is_flag=True, help="Print index statistics to stderr")
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Scan sessions in this many processes when not using the index (0: one per CPU)",
+)
 @click.argument("pattern", nargs=1, required=True)
 def main(
-    ignore_case: bool, files_with_matches: bool, fixed_strings: bool, pattern: str
+    obj: Obj,
+    ignore_case: bool,
+    files_with_matches: bool,
+    fixed_strings: bool,
+    use_index: bool,
+    reindex: bool,
+    stats: bool,
+    jobs: int,
+    pattern: str,
 ) -> None:
     """Search sessions for pattern"""
     console = rich.get_console()
@@ -48,8 +70,30 @@ def main(
         pattern = re.escape(pattern)
 
     rx = re.compile(pattern, re.I if ignore_case else 0)
+
+    index = None
+    if use_index or reindex:
+        if not isinstance(obj.storage, FileStorage):
+            print(
+                "The index is only used with --storage files, searching without it",
+                file=sys.stderr,
+            )
+        elif fts5_available():
+            index = SearchIndex()
+            index.update(all_session_paths(default_conversations_path), reindex=reindex)
+        else:
+            print(
+                "SQLite FTS5 is not available, searching without an index",
+                file=sys.stderr,
+            )
+
+    matches = (
+        index.search(rx)
+        if index is not None
+        else list_files_matching_rx(rx, None, jobs, files_with_matches, obj.storage)
+    )
     last_file = None
-    for f, m in list_files_matching_rx(rx, None):
+    for f, m in matches:
         if f != last_file:
             if files_with_matches:
                 print(f)
@@ -65,6 +109,11 @@ def main(
             m.content, _ = rx.subn(lambda p: f"**{p.group(0)}**", m.content)
             console.print(to_markdown(m))
 
+    if index is not None:
+        if stats or reindex:
+            print(index.stats, file=sys.stderr)
+        index.close()
+
 
 if __name__ == "__main__":
     main()
@@ -4,81 +4,335 @@
 
 from __future__ import annotations
 
+import collections
+import concurrent.futures
+import hashlib
 import json
+import os
 import pathlib
-from typing import Any, Iterator, TextIO
+import tempfile
+from dataclasses import dataclass
+from typing import Any, Iterator, TextIO, cast
 
 import click
 import rich
+from typing_extensions import TypedDict
 
-from ..core import conversations_path, new_session_path
-from ..session import Message, Role, Session, new_session, session_to_file
+from ..core import Obj, conversations_path, new_session_path
+from ..session import Message, Role, Session, message_to_dict
+from ..storage import StorageEngine
 
 console = rich.get_console()
 
+_decoder = json.JSONDecoder()
 
-def iter_sessions(
-    name: str, content: Any, session_in: Session, node_id: str
-) -> Iterator[tuple[str, Session]]:
-    node = content["mapping"][node_id]
-    session = session_in[:]
 
-    if "message" in node:
-        role = node["message"]["author"]["role"]
-        text_content = "".join(node["message"]["content"]["parts"])
-        session.append(Message(role=role, content=text_content))
+def iter_conversations(
+    f: TextIO, chunk_size: int = 1 << 20
+) -> Iterator[tuple[int | None, Any]]:
+    """Yield each conversation in an export, without reading all of it at once
 
-    if children := node.get("children"):
-        for c in children:
-            yield from iter_sessions(name, content, session, c)
-    else:
-        title = content.get("title") or "Untitled"
-        session[0] = Message(
+    An export is either a single conversation, or (for a full account
+    export) a list of them. Each conversation is yielded with its index in
+    the list, or None if the export is a single conversation. Only one
+    conversation at a time is decoded."""
+    buf = f.read(chunk_size)
+    eof = not buf
+    pos = 0
+
+    def skip(chars: str) -> None:
+        nonlocal buf, pos, eof
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            buf = f.read(chunk_size)
+            pos = 0
+            eof = not buf
+
+    skip(" \t\r\n")
+    in_list = buf.startswith("[", pos)
+    if in_list:
+        pos += 1
+    index = 0
+    while True:
+        skip(" \t\r\n," if in_list else " \t\r\n")
+        if pos == len(buf) or (in_list and buf[pos] == "]"):
+            return
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(buf, pos)
+                break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            # The object isn't complete yet; read at least as much again as
+            # is buffered, so that re-decoding a large object stays linear
+            more = f.read(max(chunk_size, len(buf) - pos))
+            buf = buf[pos:] + more
+            pos = 0
+            eof = not more
+        yield (index if in_list else None), obj
+        pos = end
+        if not in_list:
+            return
+        index += 1
+
+
+def node_message(node: Any) -> Message | None:
+    message = node.get("message")
+    if not message:
+        return None
+    role = message["author"]["role"]
+    parts = message["content"].get("parts") or []
+    text_content = "".join(p for p in parts if isinstance(p, str))
+    return Message(role=role, content=text_content)
+
+
+def iter_sessions(name: str, content: Any, root: str) -> Iterator[tuple[str, Session]]:
+    """Yield the id of each leaf of the conversation tree, with the session
+    leading to it
+
+    The tree is walked without recursion, and each node's message is only
+    created once, so the sessions of different branches share the messages
+    they have in common."""
+    mapping = content["mapping"]
+    title = content.get("title") or "Untitled"
+    # Each node's message (or None) and the node it was reached from
+    messages: dict[str, Message | None] = {}
+    parents: dict[str, str | None] = {root: None}
+    stack = [root]
+    while stack:
+        node_id = stack.pop()
+        node = mapping[node_id]
+        messages[node_id] = node_message(node)
+        if children := node.get("children"):
+            for c in reversed(children):
+                parents[c] = node_id
+                stack.append(c)
+            continue
+
+        branch: list[Message] = []
+        step: str | None = node_id
+        while step is not None:
+            if (message := messages[step]) is not None:
+                branch.append(message)
+            step = parents[step]
+        branch.reverse()
+        system = Message(
             Role.SYSTEM,
             f"# {title}\nChatGPT session imported from {name}, branch {node_id}.\n\n",
         )
-        yield node_id, session
+        yield node_id, [system, *branch]
 
 
-def do_import(output_directory: pathlib.Path, f: TextIO) -> None:
-    stem = pathlib.Path(f.name).stem
-    content = json.load(f)
-    session = new_session()
+# Each output directory records what was imported into it, so that importing
+# a newer export only writes the branches that changed. It maps each
+# conversation's id to the name its sessions were saved under, and the
+# content hash of each of its branches. Conversations are keyed by id rather
+# than by name, since a single-conversation export is named after its file.
+imports_manifest_name = ".imports.json"
+ImportedDict = TypedDict("ImportedDict", {"stem": str, "branches": dict[str, str]})
 
-    default_branch = content["current_node"]
-    console.print(f"Importing [bold]{f.name}[nobold]")
+
+def read_imports_manifest(directory: pathlib.Path) -> dict[str, ImportedDict]:
+    try:
+        with open(directory / imports_manifest_name, encoding="utf-8") as f:
+            return cast(dict[str, ImportedDict], json.load(f))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_imports_manifest(
+    directory: pathlib.Path, manifest: dict[str, ImportedDict]
+) -> None:
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".imports", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, directory / imports_manifest_name)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def branch_hash(title: str, session: Session, filename: str) -> str:
+    """Hash what is imported of a branch: the title, the messages and the
+    name of the file it is saved as (which depends on whether it is the
+    conversation's current branch), but not the name of the export file,
+    which is different each time"""
+    h = hashlib.sha256(json.dumps([title, filename]).encode("utf-8"))
+    for message in session[1:]:
+        h.update(json.dumps(message_to_dict(message)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def import_conversation(
+    output_directory: pathlib.Path,
+    name: str,
+    stem: str,
+    content: Any,
+    storage_type: type[StorageEngine],
+    previous: dict[str, str],
+) -> tuple[list[pathlib.Path], dict[str, str]]:
+    """Save the new or changed branches of one conversation
+
+    previous holds the hash of each branch as it was last imported. Return
+    the paths that were written, and the hashes of all the branches.
+
+    This runs in worker processes, each with its own storage engine."""
+    storage = _worker_storage(storage_type)
+    default_branch = content.get("current_node")
+    title = content.get("title") or "Untitled"
     root = [k for k, v in content["mapping"].items() if not v.get("parent")][0]
-    for branch, session in iter_sessions(f.name, content, session, root):
+    written = []
+    hashes = {}
+    for branch, session in iter_sessions(name, content, root):
         if branch == default_branch:
             session_filename = new_session_path(output_directory / (f"{stem}.json"))
         else:
             session_filename = new_session_path(
                 output_directory / (f"{stem}_{branch}.json")
             )
-        session_to_file(session, session_filename)
-        console.print(f" -> {session_filename}")
+        hashes[branch] = branch_hash(title, session, session_filename.name)
+        if previous.get(branch) == hashes[branch] and storage.exists(session_filename):
+            continue
+        storage.save_copy(session, session_filename)
+        written.append(session_filename)
+    return written, hashes
+
+
+_storages: dict[type[StorageEngine], StorageEngine] = {}
+
+
+def _worker_storage(storage_type: type[StorageEngine]) -> StorageEngine:
+    storage = _storages.get(storage_type)
+    if storage is None:
+        storage = _storages[storage_type] = storage_type()
+    return storage
+
+
+@dataclass
+class ImportStats:
+    new: int = 0
+    """Conversations not imported before"""
+
+    updated: int = 0
+    """Conversations with new or changed branches"""
+
+    skipped: int = 0
+    """Conversations which were already imported, unchanged"""
+
+    def __str__(self) -> str:
+        return f"{self.new} new, {self.updated} updated, {self.skipped} unchanged conversations"
+
+
+def do_import(
+    output_directory: pathlib.Path,
+    f: TextIO,
+    storage: StorageEngine,
+    jobs: int = 0,
+    stats: ImportStats | None = None,
+) -> None:
+    stem = pathlib.Path(f.name).stem
+    console.print(f"Importing [bold]{f.name}[nobold]")
+    stats = stats or ImportStats()
+    manifest = read_imports_manifest(output_directory)
+    workers = jobs or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Only a few conversations are decoded ahead of the ones being
+        # converted, so memory use doesn't grow with the size of the export
+        pending: collections.deque[
+            tuple[
+                str,
+                str,
+                concurrent.futures.Future[tuple[list[pathlib.Path], dict[str, str]]],
+            ]
+        ]
+        pending = collections.deque()
+
+        def finish_oldest() -> None:
+            conversation_id, conversation_stem, future = pending.popleft()
+            written, hashes = future.result()
+            if conversation_id not in manifest:
+                stats.new += 1
+            elif written:
+                stats.updated += 1
+            else:
+                stats.skipped += 1
+            manifest[conversation_id] = {
+                "stem": conversation_stem,
+                "branches": hashes,
+            }
+            for session_filename in written:
+                console.print(f" -> {session_filename}")
+
+        try:
+            for index, content in iter_conversations(f):
+                conversation_id = content.get("id") or content.get("conversation_id")
+                conversation_stem = stem
+                if index is not None:
+                    # Name the conversations of a full account export by their ids
+                    conversation_stem = conversation_id or f"{stem}_{index}"
+                conversation_id = conversation_id or conversation_stem
+                # A conversation imported before is saved under the same name
+                # again, even if the export file has been renamed since
+                previous = manifest.get(conversation_id)
+                if previous is not None:
+                    conversation_stem = previous.get("stem", conversation_stem)
+                future = executor.submit(
+                    import_conversation,
+                    output_directory,
+                    f.name,
+                    conversation_stem,
+                    content,
+                    type(storage),
+                    previous.get("branches", {}) if previous is not None else {},
+                )
+                pending.append((conversation_id, conversation_stem, future))
+                if len(pending) >= 2 * workers:
+                    finish_oldest()
+            while pending:
+                finish_oldest()
+        finally:
+            # Record whatever was imported, even if the import stopped early
+            write_imports_manifest(output_directory, manifest)
 
 
 @click.command
+@click.pass_obj
 @click.option(
     "--output-directory",
     "-o",
     type=click.Path(file_okay=False, path_type=pathlib.Path),
     default=conversations_path,
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Convert conversations in this many processes (0: one per CPU)",
+)
 @click.argument(
     "files", nargs=-1, required=True, type=click.File("r", encoding="utf-8")
 )
-def main(output_directory: pathlib.Path, files: list[TextIO]) -> None:
+def main(
+    obj: Obj, output_directory: pathlib.Path, jobs: int, files: list[TextIO]
+) -> None:
     """Import files from the ChatGPT webui
 
     This understands the format produced by
-    https://github.com/pionxzh/chatgpt-exporter though it only exports the
-    'final version' of the conversation, not all the branches"""
+    https://github.com/pionxzh/chatgpt-exporter as well as the
+    conversations.json of a full ChatGPT account export, and imports all the
+    branches of each conversation"""
 
     output_directory.mkdir(parents=True, exist_ok=True)
+    stats = ImportStats()
     for f in files:
-        do_import(output_directory, f)
+        do_import(output_directory, f, obj.storage, jobs, stats)
+    console.print(f"Imported {stats}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,56 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import pathlib
+import sys
+import time
+
+import click
+
+from ..core import conversations_path
+from ..session import (
+    pack_session_files,
+    read_recent_manifest,
+    rebuild_recent_manifest,
+    session_files,
+)
+
+
+@click.command
+@click.option(
+    "--days",
+    type=click.FloatRange(min=0),
+    default=30,
+    help="Pack sessions that have not been modified for this many days",
+)
+@click.option(
+    "--directory",
+    "-d",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default=conversations_path,
+)
+def main(days: float, directory: pathlib.Path) -> None:
+    """Move old sessions into a pack file
+
+    Packed sessions can still be opened by name with '--continue-session', and
+    are searched by 'chap grep'. If a packed session is continued, it is saved
+    as an ordinary file again."""
+    cutoff = time.time() - days * 86400
+    paths = sorted(p for p in session_files(directory) if p.stat().st_mtime < cutoff)
+    if not paths:
+        print("No sessions to pack", file=sys.stderr)
+        return
+
+    pack = pack_session_files(directory, paths)
+
+    if read_recent_manifest(directory, check_fresh=False) is not None:
+        rebuild_recent_manifest(directory)
+
+    print(f"Packed {len(paths)} sessions into {pack}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
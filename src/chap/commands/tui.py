@@ -16,8 +16,11 @@ from textual.containers import Container, Horizontal, VerticalScroll
 from textual.keys import Keys
 from textual.widgets import Button, Footer, LoadingIndicator, Markdown, TextArea
 
+from ..clients import run
 from ..core import Backend, Obj, command_uses_new_session, get_api, new_session_path
-from ..session import Assistant, Message, Session, User, new_session, session_to_file
+from ..session import Assistant, Message, Session, User, new_session
+from ..storage import FileStorage, StorageEngine
+from ..summary import summarized_view, update_summary
 
 
 # workaround for pyperclip being un-typed
@@ -79,13 +82,19 @@ class Tui(App[None]):
     ]
 
     def __init__(
-        self, api: Optional[Backend] = None, session: Optional[Session] = None
+        self,
+        api: Optional[Backend] = None,
+        session: Optional[Session] = None,
+        storage: Optional[StorageEngine] = None,
+        summarize: float = 0,
     ) -> None:
         super().__init__()
         self.api = api or get_api(click.Context(click.Command("chap tui")), "lorem")
         self.session = (
             new_session(self.api.system_message) if session is None else session
         )
+        self.storage = storage or FileStorage()
+        self.summarize = summarize
 
     @property
     def spinner(self) -> LoadingIndicator:
@@ -127,6 +136,16 @@ class Tui(App[None]):
     async def on_mount(self) -> None:
         self.container.scroll_end(animate=False)
         self.input.focus()
+        self.prewarm()
+
+    @work(exclusive=True)
+    async def prewarm(self) -> None:
+        # Backends that can have the server process the session's prompt
+        # ahead of the first question do so now (submitting a question
+        # cancels this, since its request does the same)
+        aprewarm = getattr(self.api, "aprewarm", None)
+        if aprewarm is not None:
+            await aprewarm(self.session)
 
     async def action_submit(self) -> None:
         self.get_completion(self.input.text)
@@ -150,11 +169,15 @@ class Tui(App[None]):
         for markdown in self.container.children:
             markdown.disabled = True
 
-        # Construct a fake session with only select items
-        session = []
-        for si, wi in zip(self.session, self.container.children):
-            if not wi.has_class("history_exclude"):
-                session.append(si)
+        # Construct a fake session with only select items. Summaries refer to
+        # positions in the whole session, so the view is made from that.
+        excluded = {
+            id(si)
+            for si, wi in zip(self.session, self.container.children)
+            if wi.has_class("history_exclude")
+        }
+        view = summarized_view(self.session) if self.summarize else self.session
+        view = [m for m in view if id(m) not in excluded]
 
         message = Assistant("")
         self.session.extend(
@@ -180,7 +203,7 @@ class Tui(App[None]):
                 await asyncio.sleep(0.01)
 
         async def get_token_fun() -> None:
-            async for token in self.api.aask(session, query):
+            async for token in self.api.aask(view, query):
                 message.content += token
                 try:
                     update.put_nowait(True)
@@ -192,6 +215,8 @@ class Tui(App[None]):
 
         try:
             await asyncio.gather(render_fun(), get_token_fun())
+            if self.summarize:
+                self.summarize_session(self.session, message)
         finally:
             self.input.clear()
             all_output = self.session[-1].content
@@ -208,6 +233,11 @@ class Tui(App[None]):
             self.cancel_button.disabled = True
             self.input.focus()
 
+    @work(group="summary")
+    async def summarize_session(self, session: Session, message: Message) -> None:
+        # In the background, so the next question can be asked meanwhile
+        await update_summary(self.api, session, message, self.summarize)
+
     def scroll_end(self) -> None:
         self.call_after_refresh(self.container.scroll_end)
 
@@ -260,8 +290,9 @@ class Tui(App[None]):
         while idx > 1 and not children[idx].has_class("role_user"):
             idx -= 1
 
-        # Save a copy of the discussion before this deletion
-        session_to_file(self.session, new_session_path())
+        # Save a copy of the discussion before this deletion. It usually shares
+        # most of its history with other copies, so use the object store.
+        self.storage.save_copy(self.session, new_session_path(storage=self.storage))
 
         query = self.session[idx].content
         self.input.load_text(query)
@@ -302,15 +333,15 @@ def main(obj: Obj, replace_system_prompt: bool) -> None:
             api.system_message if obj.system_message is None else obj.system_message
         )
 
-    tui = Tui(api, session)
-    tui.run()
+    tui = Tui(api, session, obj.storage, obj.summarize)
+    run(tui.run_async())
 
     sys.stdout.flush()
     sys.stderr.flush()
 
     print(f"Saving session to {session_filename}", file=sys.stderr)
 
-    session_to_file(session, session_filename)
+    obj.storage.save(session, session_filename)
 
 
 if __name__ == "__main__":
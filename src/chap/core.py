@@ -4,8 +4,6 @@
 
 
 from collections.abc import Sequence
-import asyncio
-import datetime
 import io
 import importlib
 import os
@@ -15,6 +13,7 @@ import subprocess
 import shlex
 import textwrap
 from dataclasses import MISSING, Field, dataclass, fields
+from dataclasses import field as dataclass_field
 from typing import (
     Any,
     AsyncGenerator,
@@ -32,8 +31,9 @@ import click
 import platformdirs
 from simple_parsing.docstring import get_attribute_docstring
 from typing_extensions import Protocol
-from . import backends, commands
-from .session import Message, Session, System, session_from_file
+from . import backends, clients, commands
+from .session import Message, Session, System, session_formats
+from .storage import FileStorage, StorageEngine, storage_engines
 
 UnionType: type
 if sys.version_info >= (3, 10):
@@ -60,6 +60,12 @@ class Backend(ABackend, Protocol):
         """Make a query, updating the session with the query and response, returning the query"""
 
 
+def response_failed(content: str) -> bool:
+    """Return whether a response is a backend's report of a failed request
+    (which backends give in place of the response) or is empty"""
+    return not content.strip() or content.startswith(("\nFailed with", "\nException:"))
+
+
 class AutoAskMixin:
     """Mixin class for backends implementing aask"""
 
@@ -71,20 +77,24 @@ class AutoAskMixin:
             async for token in self.aask(session, query):  # type: ignore
                 tokens.append(token)
 
-        asyncio.run(inner())
+        clients.run(inner())
         return "".join(tokens)
 
 
-def last_session_path() -> Optional[pathlib.Path]:
-    result = max(
-        conversations_path.glob("*.json"), key=lambda p: p.stat().st_mtime, default=None
-    )
-    return result
+def last_session_path(
+    storage: Optional[StorageEngine] = None,
+) -> Optional[pathlib.Path]:
+    result = (storage or FileStorage()).recent_session_paths(conversations_path, 1)
+    return result[0] if result else None
 
 
-def new_session_path(opt_path: Optional[pathlib.Path] = None) -> pathlib.Path:
-    return opt_path or conversations_path / (
-        datetime.datetime.now().isoformat().replace(":", "_") + ".json"
+def new_session_path(
+    opt_path: Optional[pathlib.Path] = None,
+    session_format: str = "json",
+    storage: Optional[StorageEngine] = None,
+) -> pathlib.Path:
+    return opt_path or (storage or FileStorage()).new_session_path(
+        conversations_path, session_format
     )
 
 
@@ -154,14 +164,22 @@ def do_session_continue(
             "--continue-session, --last and --new-session are mutually exclusive",
             param=param,
         )
-    ctx.obj.session = session_from_file(value)
+    storage = ctx.obj.storage
+    if not storage.exists(value):
+        # Allow naming a session in the conversations directory, including
+        # one that has been packed, without giving the full path
+        in_conversations = conversations_path / value
+        if not storage.exists(in_conversations):
+            raise click.BadParameter(f"Session {value} does not exist", param=param)
+        value = in_conversations
+    ctx.obj.session = storage.load(value, lazy=True)
     ctx.obj.session_filename = value
 
 
 def do_session_last(ctx: click.Context, param: click.Parameter, value: bool) -> None:
     if not value:
         return
-    do_session_continue(ctx, param, last_session_path())
+    do_session_continue(ctx, param, last_session_path(ctx.obj.storage))
 
 
 def do_session_new(
@@ -174,7 +192,7 @@ def do_session_new(
             "--continue-session, --last and --new-session are mutually exclusive",
             param=param,
         )
-    session_filename = new_session_path(value)
+    session_filename = new_session_path(value, ctx.obj.session_format, ctx.obj.storage)
     system_message = ctx.obj.system_message or ctx.obj.api.system_message
     ctx.obj.session = [System(system_message)]
     ctx.obj.session_filename = session_filename
@@ -201,6 +219,34 @@ def set_system_message_from_file(
     ctx.obj.system_message = content
 
 
+def set_session_format(ctx: click.Context, param: click.Parameter, value: str) -> None:
+    ctx.obj.session_format = value
+
+
+def set_storage(ctx: click.Context, param: click.Parameter, value: str) -> None:
+    ctx.obj.storage = storage_engines[value]()
+
+
+def set_summarize(ctx: click.Context, param: click.Parameter, value: float) -> None:
+    ctx.obj.summarize = value
+
+
+def set_http2(ctx: click.Context, param: click.Parameter, value: bool) -> None:
+    clients.configure(use_http2=value)
+
+
+def set_max_connections(
+    ctx: click.Context, param: click.Parameter, value: Optional[int]
+) -> None:
+    clients.configure(max_connections=value)
+
+
+def set_keepalive(
+    ctx: click.Context, param: click.Parameter, value: Optional[float]
+) -> None:
+    clients.configure(keepalive_expiry=value)
+
+
 def set_backend(ctx: click.Context, param: click.Parameter, value: str) -> None:
     if value == "list":
         formatter = ctx.make_formatter()
@@ -278,7 +324,7 @@ def uses_session(f: click.decorators.FC) -> Callable[[], None]:
     f = click.option(
         "--continue-session",
         "-s",
-        type=click.Path(exists=True),
+        type=click.Path(path_type=pathlib.Path),
         default=None,
         callback=do_session_continue,
         expose_value=False,
@@ -337,6 +383,9 @@ class Obj:
     system_message: Optional[str] = None
     session: Optional[list[Message]] = None
     session_filename: Optional[pathlib.Path] = None
+    session_format: str = "json"
+    storage: StorageEngine = dataclass_field(default_factory=FileStorage)
+    summarize: float = 0
 
 
 def maybe_add_txt_extension(fn: pathlib.Path) -> pathlib.Path:
@@ -551,6 +600,59 @@ main = MyCLI(
             envvar="CHAP_BACKEND",
             help="The back-end to use ('--backend list' for a list)",
         ),
+        click.Option(
+            ("--session-format",),
+            type=click.Choice(session_formats),
+            default="json",
+            callback=set_session_format,
+            expose_value=False,
+            envvar="CHAP_SESSION_FORMAT",
+            help="The file format for new sessions. 'jsonl' sessions are saved by appending only the new messages. '.gz' and '.zst' (requires the zstandard package) formats are compressed.",
+        ),
+        click.Option(
+            ("--storage",),
+            type=click.Choice(list(storage_engines)),
+            default="files",
+            callback=set_storage,
+            expose_value=False,
+            envvar="CHAP_STORAGE",
+            help="Where sessions are kept: one file per session ('files'), or rows of an SQLite database in the conversations directory ('sqlite'). --session-format only applies to 'files'.",
+        ),
+        click.Option(
+            ("--summarize",),
+            type=float,
+            default=0,
+            callback=set_summarize,
+            expose_value=False,
+            envvar="CHAP_SUMMARIZE",
+            help="When a session no longer fits in the backend's max_request_tokens, have the backend summarize all but the most recent messages that fit in this fraction of it (e.g., 0.5), and send the summary (saved in the session) in their place from then on. 0 turns this off.",
+        ),
+        click.Option(
+            ("--http2/--no-http2",),
+            default=False,
+            callback=set_http2,
+            expose_value=False,
+            envvar="CHAP_HTTP2",
+            help="Use HTTP/2 with servers that support it (requires the h2 package)",
+        ),
+        click.Option(
+            ("--max-connections",),
+            type=click.IntRange(min=1),
+            default=None,
+            callback=set_max_connections,
+            expose_value=False,
+            envvar="CHAP_MAX_CONNECTIONS",
+            help="The most connections to keep open to each server [default: 20]",
+        ),
+        click.Option(
+            ("--keepalive",),
+            type=click.FloatRange(min=0),
+            default=None,
+            callback=set_keepalive,
+            expose_value=False,
+            envvar="CHAP_KEEPALIVE",
+            help="How many seconds to keep an unused connection open for the next request [default: 300]",
+        ),
         click.Option(
             ("--backend-option", "-B"),
             type=colonstr,
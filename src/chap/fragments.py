@@ -0,0 +1,178 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import itertools
+import json
+import operator
+from typing import Any, Callable, Optional, Sequence, Tuple, Union
+
+from .session import Message, Session
+
+_encode_string = json.encoder.encode_basestring_ascii  # type: ignore[attr-defined]
+_content = operator.attrgetter("content")
+
+
+class FragmentCache:
+    """Builds request text from rendered messages, rendering each message once
+
+    Each message is rendered (e.g., as a JSON object, or with a prompt
+    template) into a fragment, and the fragments are joined with separator.
+    The joined text of earlier requests is kept, so that a request whose
+    messages appeared, in the same order, in earlier requests is mostly
+    copied from it, and only new or changed messages are rendered."""
+
+    def __init__(self, render: Callable[[Message], str], separator: str = "") -> None:
+        self.render = render
+        self.separator = separator
+        self.clear()
+
+    def clear(self) -> None:
+        # Every message rendered since the cache was last cleared, in the
+        # order they were rendered, and where each one's fragment (followed
+        # by the separator) starts in the text
+        self.messages: list[Message] = []
+        self.contents: list[str] = []
+        self.offsets = [0]
+        self.where: dict[int, int] = {}
+        self.text = ""
+        self.pending: list[str] = []
+
+    def _unchanged(self, message: Message, pos: int) -> bool:
+        return message is self.messages[pos] and message.content is self.contents[pos]
+
+    def _run_length(self, messages: Session, i: int, pos: int) -> int:
+        # The number of messages from messages[i] on that are also found,
+        # unchanged and in order, from self.messages[pos] on; the first is
+        # known to be
+        n = min(len(messages) - i, len(self.messages) - pos)
+        # Usually that's all of them, which can be checked without a loop in
+        # Python (identical objects compare equal without calling __eq__)
+        if (
+            messages[i : i + n] == self.messages[pos : pos + n]
+            and list(map(_content, messages[i : i + n])) == self.contents[pos : pos + n]
+        ):
+            return n
+        run = 1
+        while run < n and self._unchanged(messages[i + run], pos + run):
+            run += 1
+        return run
+
+    def _add(self, message: Message, fragment: str) -> None:
+        # A message that changed is added again, and its old fragment is
+        # left unused
+        self.where[id(message)] = len(self.messages)
+        self.messages.append(message)
+        self.contents.append(message.content)
+        self.offsets.append(self.offsets[-1] + len(fragment))
+        self.pending.append(fragment)
+
+    def _flush(self) -> None:
+        if self.pending:
+            self.text += "".join(self.pending)
+            self.pending.clear()
+
+    def join(self, messages: Session) -> str:
+        """Return the fragments of messages, joined with the separator"""
+        if not self.messages:
+            return self._fill(messages)
+
+        # New fragments, and the spans of the text with runs of messages
+        # that were rendered before
+        parts: list[Union[str, Tuple[int, int]]] = []
+        i = 0
+        while i < len(messages):
+            message = messages[i]
+            pos = self.where.get(id(message))
+            if pos is not None and self._unchanged(message, pos):
+                run = self._run_length(messages, i, pos)
+                if self.offsets[pos + run] > len(self.text):
+                    self._flush()
+                parts.append((self.offsets[pos], self.offsets[pos + run]))
+                i += run
+                continue
+            fragment = self.render(message) + self.separator
+            self._add(message, fragment)
+            parts.append(fragment)
+            i += 1
+        self._flush()
+
+        # Leave out the separator after the last fragment
+        if parts and self.separator:
+            last = parts[-1]
+            if isinstance(last, tuple):
+                parts[-1] = (last[0], last[1] - len(self.separator))
+            else:
+                parts[-1] = last[: -len(self.separator)]
+        result = "".join(
+            self.text[part[0] : part[1]] if isinstance(part, tuple) else part
+            for part in parts
+        )
+
+        # Messages which were sent before, but not now (those trimmed from
+        # the start of a long session, or deleted from its end) are kept
+        # until they make up most of the text
+        if len(self.text) > 2 * len(result) + 65536:
+            self._compact(messages)
+        return result
+
+    def _fill(self, messages: Session) -> str:
+        # With nothing to reuse, as in the first request of a process, render
+        # all the messages and fill the cache with as little overhead as
+        # possible
+        fragments = list(map(self.render, messages))
+        result = self.separator.join(fragments)
+        self.text = result + self.separator
+        self.messages = list(messages)
+        self.contents = list(map(_content, messages))
+        self.offsets = list(
+            itertools.accumulate(
+                (len(f) + len(self.separator) for f in fragments), initial=0
+            )
+        )
+        self.where = {id(message): i for i, message in enumerate(messages)}
+        return result
+
+    def _compact(self, messages: Session) -> None:
+        old_text, old_offsets, old_where = self.text, self.offsets, self.where
+        self.clear()
+        for message in messages:
+            if id(message) in self.where:
+                continue
+            pos = old_where[id(message)]
+            fragment = old_text[old_offsets[pos] : old_offsets[pos + 1]]
+            self._add(message, fragment)
+        self._flush()
+
+
+def message_json(message: Message) -> str:
+    """Return json.dumps(message_to_dict(message)), but faster"""
+    return (
+        f'{{"role": {_encode_string(message.role)},'
+        f' "content": {_encode_string(message.content)}}}'
+    )
+
+
+def json_request_body(
+    fields: dict[str, Any],
+    messages: Session,
+    cache: Optional[FragmentCache] = None,
+    more: Sequence[str] = (),
+) -> bytes:
+    """Encode fields, plus messages as a list under "messages", as a JSON object
+
+    This is the same as json.dumps({**fields, "messages":
+    session_to_list(messages)}), except that with a cache (of message_json
+    fragments joined with ","), each message is only encoded the first time
+    it is sent. more are already encoded messages to add after messages."""
+    if cache is None:
+        messages_json = ", ".join(message_json(m) for m in messages)
+    else:
+        messages_json = cache.join(messages)
+    if more:
+        messages_json = ", ".join([messages_json, *more] if messages else more)
+    encoded = json.dumps(fields)
+    separator = ", " if fields else ""
+    return f'{encoded[:-1]}{separator}"messages": [{messages_json}]}}'.encode("utf-8")
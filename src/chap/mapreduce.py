@@ -0,0 +1,200 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import asyncio
+from typing import Callable, Iterator, Optional, TextIO
+
+from .core import Backend, response_failed
+from .session import Session
+
+# Input too long for one request is read in pieces ("parts"), and the prompt
+# is asked about each part separately, several at a time. The answers are
+# then combined by asking the backend to merge a few of them at a time, over
+# and over, until one answer is left. Only the parts being asked about are
+# kept in memory, so the input can be far larger than memory.
+
+
+class PartFailed(Exception):
+    """A request about part of the input failed"""
+
+
+def split_input(
+    stream: TextIO, max_tokens: int, count: Callable[[str], int]
+) -> Iterator[str]:
+    """Yield the text of stream in parts of at most max_tokens tokens (as
+    counted by count), which end at line breaks unless a line is too long
+
+    The stream is read a little at a time, so a part is all that is ever
+    held in memory."""
+    piece_length = max(max_tokens // 8, 1)
+    parts: list[str] = []
+    total = 0
+    while piece := stream.readline(piece_length):
+        n = count(piece)
+        if parts and total + n > max_tokens:
+            yield "".join(parts)
+            parts.clear()
+            total = 0
+        parts.append(piece)
+        total += n
+    if parts:
+        yield "".join(parts)
+
+
+def part_query(prompt: str, i: int, text: str) -> str:
+    return (
+        f"{prompt}\n\nThe input is too long to read at once, so it is given in"
+        f" parts. Answer for this part alone. This is part {i}:\n\n{text}"
+    )
+
+
+def combine_query(prompt: str, answers: list[str]) -> str:
+    return (
+        f"{prompt}\n\nThe input was too long to read at once, so this was"
+        " answered for each of its parts, in order. Combine these answers into"
+        " one answer:\n\n"
+        + "\n\n".join(f"Answer {i}:\n{answer}" for i, answer in enumerate(answers, 1))
+    )
+
+
+def group_answers(
+    prompt: str, answers: list[str], max_tokens: int, count: Callable[[str], int]
+) -> list[list[str]]:
+    """Split answers, in order, into groups whose combine_query fits in
+    max_tokens, with at least two answers per group (so that each round of
+    combining leaves fewer)"""
+    base = count(combine_query(prompt, []))
+    groups: list[list[str]] = []
+    group: list[str] = []
+    total = base
+    for answer in answers:
+        # Allow for the "Answer N:" heading
+        n = count(answer) + 8
+        if len(group) >= 2 and total + n > max_tokens:
+            groups.append(group)
+            group = []
+            total = base
+        group.append(answer)
+        total += n
+    if len(group) == 1 and groups:
+        groups[-1].append(group[0])
+    elif group:
+        groups.append(group)
+    return groups
+
+
+async def _cancel(tasks: list[asyncio.Task[str]]) -> None:
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _gather(tasks: list[asyncio.Task[str]]) -> list[str]:
+    """Return the results of tasks, cancelling the rest as soon as one fails"""
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        await _cancel(tasks)
+        raise
+
+
+async def map_reduce(
+    api: Backend,
+    system: Session,
+    prompt: str,
+    parts: Iterator[str],
+    max_tokens: int,
+    count: Callable[[str], int],
+    jobs: int = 4,
+    output: Callable[[str], None] = lambda token: None,
+    progress: Callable[[int, int], None] = lambda done, read: None,
+) -> str:
+    """Ask prompt about each of parts and combine the answers into one,
+    with at most jobs requests at once, returning the final answer
+
+    Each request starts with the messages of system. The final answer's
+    tokens are passed to output as they arrive (when there is just one part,
+    this is the answer about it). progress is called with the number of parts
+    answered and read so far. Raises PartFailed if any request fails; once
+    one has, no more of the input is read and the other requests are
+    cancelled."""
+    semaphore = asyncio.Semaphore(max(jobs, 1))
+
+    async def stream(query: str) -> str:
+        tokens = []
+        async for token in api.aask(system[:], query):
+            output(token)
+            tokens.append(token)
+        return "".join(tokens)
+
+    async def answer(what: str, query: str) -> str:
+        try:
+            content = "".join([token async for token in api.aask(system[:], query)])
+        finally:
+            semaphore.release()
+        if response_failed(content):
+            raise PartFailed(f"The request for {what} failed: {content.strip()}")
+        return content
+
+    async def read() -> Optional[str]:
+        # The input may be a slow pipe, so it's read off the event loop
+        return await asyncio.to_thread(next, parts, None)
+
+    first = await read()
+    if first is None:
+        return ""
+    second = await read()
+    if second is None:
+        return await stream(f"{prompt}\n\n{first}")
+
+    done = 0
+    failed = False
+    tasks: list[asyncio.Task[str]] = []
+
+    def finished(task: asyncio.Task[str]) -> None:
+        nonlocal done, failed
+        if task.cancelled() or task.exception() is not None:
+            failed = True
+            return
+        done += 1
+        progress(done, len(tasks))
+
+    # A part is only read once there's a request free to ask about it, and
+    # not at all once a request has failed
+    ahead = [first, second]
+    try:
+        while True:
+            await semaphore.acquire()
+            text = None if failed else (ahead.pop(0) if ahead else await read())
+            if text is None:
+                semaphore.release()
+                break
+            i = len(tasks) + 1
+            task = asyncio.create_task(answer(f"part {i}", part_query(prompt, i, text)))
+            task.add_done_callback(finished)
+            tasks.append(task)
+    except BaseException:
+        await _cancel(tasks)
+        raise
+    answers = await _gather(tasks)
+
+    while True:
+        groups = group_answers(prompt, answers, max_tokens, count)
+        if len(groups) == 1:
+            return await stream(combine_query(prompt, groups[0]))
+        combining: list[asyncio.Task[str]] = []
+        try:
+            for group in groups:
+                await semaphore.acquire()
+                combining.append(
+                    asyncio.create_task(
+                        answer("combining answers", combine_query(prompt, group))
+                    )
+                )
+        except BaseException:
+            await _cancel(combining)
+            raise
+        answers = await _gather(combining)
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import struct
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+
+# A pack holds many session files in one. It is the concatenation of the
+# original files' bytes (still compressed, if they were), followed by a json
+# index of where each one is, followed by a trailer giving the offset of the
+# index. Packs live in a hidden subdirectory of the directory their sessions
+# came from, and a packed session is still addressed by its original path.
+packs_directory_name = ".packs"
+pack_suffix = ".pack"
+pack_magic = b"CHAPPACK"
+_trailer = struct.Struct("<Q8s")
+
+
+@dataclass(frozen=True)
+class PackEntry:
+    pack: pathlib.Path
+    offset: int
+    size: int
+    mtime_ns: int
+
+
+def packs_path(directory: pathlib.Path) -> pathlib.Path:
+    return directory / packs_directory_name
+
+
+def read_pack_index(pack: pathlib.Path) -> dict[str, PackEntry]:
+    with open(pack, "rb") as f:
+        f.seek(-_trailer.size, os.SEEK_END)
+        index_offset, magic = _trailer.unpack(f.read(_trailer.size))
+        if magic != pack_magic:
+            raise ValueError(f"{pack} is not a chap pack file")
+        end = f.tell() - _trailer.size
+        f.seek(index_offset)
+        index = json.loads(f.read(end - index_offset))
+    return {
+        name: PackEntry(pack, offset, size, mtime_ns)
+        for name, (offset, size, mtime_ns) in index.items()
+    }
+
+
+_index_cache: dict[pathlib.Path, tuple[int, dict[str, PackEntry]]] = {}
+
+
+def pack_index(directory: pathlib.Path) -> dict[str, PackEntry]:
+    """Return the entries of all the packs of sessions from directory
+
+    If a name is in more than one pack, the newest pack's entry is used. The
+    result is cached until the packs directory changes."""
+    packs = packs_path(directory)
+    try:
+        mtime_ns = packs.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _index_cache.get(packs)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    result: dict[str, PackEntry] = {}
+    # pack names sort by creation time, so later packs override earlier ones
+    for pack in sorted(packs.glob(f"*{pack_suffix}")):
+        result.update(read_pack_index(pack))
+    _index_cache[packs] = (mtime_ns, result)
+    return result
+
+
+def find_packed(path: Union[pathlib.Path, str]) -> Optional[PackEntry]:
+    path = pathlib.Path(path)
+    return pack_index(path.parent).get(path.name)
+
+
+def read_packed(path: Union[pathlib.Path, str]) -> bytes:
+    """Return the original bytes of a packed session file"""
+    entry = find_packed(path)
+    if entry is None:
+        raise FileNotFoundError(f"No such session: {path}")
+    with open(entry.pack, "rb") as f:
+        f.seek(entry.offset)
+        return f.read(entry.size)
+
+
+def packed_paths(directory: pathlib.Path) -> list[pathlib.Path]:
+    """Return the original paths of the sessions packed from directory,
+    except those that also exist as ordinary files"""
+    return [
+        directory / name
+        for name in sorted(pack_index(directory))
+        if not (directory / name).exists()
+    ]
+
+
+def write_pack(directory: pathlib.Path, paths: Iterable[pathlib.Path]) -> pathlib.Path:
+    """Pack the given session files from directory, and remove them
+
+    The files are only removed once the pack is complete."""
+    packs = packs_path(directory)
+    packs.mkdir(exist_ok=True)
+    index: dict[str, tuple[int, int, int]] = {}
+    packed = []
+    fd, tmp = tempfile.mkstemp(dir=packs, prefix=".pack", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for path in paths:
+                data = path.read_bytes()
+                index[path.name] = (out.tell(), len(data), path.stat().st_mtime_ns)
+                out.write(data)
+                packed.append(path)
+            index_offset = out.tell()
+            out.write(json.dumps(index).encode("utf-8"))
+            out.write(_trailer.pack(index_offset, pack_magic))
+        pack = packs / f"pack-{time.time_ns()}{pack_suffix}"
+        os.replace(tmp, pack)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    for path in packed:
+        path.unlink()
+    return pack
@@ -0,0 +1,153 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import bisect
+import collections
+import heapq
+import math
+import re
+from array import array
+from typing import Callable
+
+from .session import Message, Role, Session
+
+_word = re.compile(r"\w\w+")
+
+
+def terms(text: str) -> list[str]:
+    return _word.findall(text.lower())
+
+
+class RelevanceIndex:
+    """An in-memory BM25 index of the messages of a session
+
+    Sessions change by adding messages at the end, so the index is kept
+    between requests and only the new messages are indexed. If an earlier
+    message changed (as by redrafting in the tui), the index is rebuilt."""
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self.messages: list[Message] = []
+        self.contents: list[str] = []
+        self.lengths = array("I")
+        self.total_length = 0
+        # For each term, the messages it appears in (in order) and how often
+        self.postings: dict[str, tuple[array[int], array[int]]] = {}
+
+    def _unchanged(self, history: Session, i: int) -> bool:
+        message = history[i]
+        return message is self.messages[i] and message.content is self.contents[i]
+
+    def update(self, history: Session) -> None:
+        """Index the messages of history that aren't already"""
+        n = min(len(history), len(self.messages))
+        if n and not (self._unchanged(history, 0) and self._unchanged(history, n - 1)):
+            # Changes are at the end, so if the first message is still the
+            # same, the messages still indexed are a prefix
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._unchanged(history, mid):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            n = lo
+        if n < len(self.messages):
+            self.clear()
+            n = 0
+        for message in history[n:]:
+            self._add(message)
+
+    def _add(self, message: Message) -> None:
+        doc = len(self.messages)
+        content = message.content
+        words = terms(content)
+        self.messages.append(message)
+        self.contents.append(content)
+        self.lengths.append(len(words))
+        self.total_length += len(words)
+        for term, tf in collections.Counter(words).items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array("I"), array("I"))
+            posting[0].append(doc)
+            posting[1].append(tf)
+
+    def scores(self, query: str, end: int) -> dict[int, float]:
+        """Return the BM25 score of query for each message before end that
+        has any of its terms"""
+        n = len(self.messages)
+        if not n:
+            return {}
+        k1, b = self.k1, self.b
+        average = self.total_length / n or 1
+        result: dict[int, float] = collections.defaultdict(float)
+        for term in set(terms(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            docs, tfs = posting
+            df = len(docs)
+            # Terms in most messages say little, and take the longest
+            if df > n // 2:
+                continue
+            idf = math.log((n - df + 0.5) / (df + 0.5) + 1)
+            lengths = self.lengths
+            for i in range(bisect.bisect_left(docs, end)):
+                doc = docs[i]
+                tf = tfs[i]
+                norm = k1 * (1 - b + b * lengths[doc] / average)
+                result[doc] += idf * tf * (k1 + 1) / (tf + norm)
+        return result
+
+
+# The most exchanges considered for adding to a request, best first
+max_candidates = 64
+
+
+def select_relevant(
+    index: RelevanceIndex,
+    history: Session,
+    end: int,
+    budget: int,
+    size: Callable[[Message], int],
+) -> Session:
+    """Return the exchanges from history[1:end] that best match the last
+    message of history, as many as fit in budget, in their original order
+
+    An exchange is a user message and the replies that follow it; its score
+    is the sum of its messages' scores. size gives the tokens a message
+    takes."""
+    index.update(history)
+    scores = index.scores(history[-1].content, end)
+
+    # The exchange each scored message belongs to, by where it starts
+    exchanges: dict[int, float] = collections.defaultdict(float)
+    for doc, score in scores.items():
+        start = doc
+        while start > 1 and history[start].role != Role.USER:
+            start -= 1
+        if start >= 1:
+            exchanges[start] += score
+
+    chosen: list[tuple[int, int]] = []
+    for _, start in heapq.nlargest(
+        max_candidates, ((score, start) for start, score in exchanges.items())
+    ):
+        stop = start + 1
+        while stop < end and history[stop].role != Role.USER:
+            stop += 1
+        cost = sum(size(m) for m in history[start:stop])
+        if cost <= budget:
+            chosen.append((start, stop))
+            budget -= cost
+    chosen.sort()
+    return [m for start, stop in chosen for m in history[start:stop]]
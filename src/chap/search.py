@@ -0,0 +1,373 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import itertools
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import sys
+import warnings
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional, Tuple, cast
+
+import platformdirs
+
+from .session import (
+    Message,
+    is_jsonl,
+    message_from_dict,
+    objects_path,
+    open_session_file,
+    session_file_stat,
+    session_from_file,
+    session_from_json,
+)
+
+with warnings.catch_warnings():
+    # sre_parse is deprecated as a public module, but it's the only way to
+    # look inside a pattern without reimplementing the regular expression parser
+    warnings.simplefilter("ignore", DeprecationWarning)
+    import sre_constants
+    import sre_parse
+
+index_path = platformdirs.user_state_path("chap") / "grep-index.sqlite3"
+
+# The trigram tokenizer can find arbitrary substrings, but only ones that are at
+# least this long
+MIN_INDEXED_LITERAL = 3
+
+
+def _literal_runs(parsed: sre_parse.SubPattern, runs: list[str]) -> None:
+    current: list[str] = []
+
+    def end_run() -> None:
+        if current:
+            runs.append("".join(current))
+            current.clear()
+
+    for op, av in parsed.data:
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))  # type: ignore[arg-type]
+            continue
+        end_run()
+        if op is sre_constants.SUBPATTERN:
+            _, add_flags, del_flags, sub = cast(
+                Tuple[Optional[int], int, int, sre_parse.SubPattern], av
+            )
+            if not add_flags and not del_flags:
+                _literal_runs(sub, runs)
+    end_run()
+
+
+def required_literals(rx: re.Pattern[str]) -> list[str]:
+    """Return strings which appear in every string that rx matches
+
+    This is conservative: anything other than plain sequences of literal
+    characters (including inside capturing groups) is ignored, so a pattern
+    like 'a|b' has no required literals at all."""
+    try:
+        parsed = sre_parse.parse(rx.pattern, rx.flags)
+    except (sre_constants.error, RecursionError):
+        return []
+    runs: list[str] = []
+    _literal_runs(parsed, runs)
+    return runs
+
+
+# Under IGNORECASE, these ASCII letters also match non-ASCII characters
+_ignorecase_extras = {
+    "i": "\u0130\u0131",
+    "k": "\u212a",
+    "s": "\u017f",
+}
+
+
+# SQLite's trigram tokenizer folds case differently from Python's IGNORECASE
+# for these letters and for non-ASCII characters, so under IGNORECASE only the
+# parts of a literal between them are looked up in the index
+_ignorecase_mismatch = re.compile(
+    "[^\\x00-\\x7f]|[" + "".join(k + k.upper() for k in _ignorecase_extras) + "]"
+)
+
+
+def _json_forms(ch: str) -> set[bytes]:
+    """The ways ch can appear inside a JSON string written by chap (or another encoder)"""
+    return {
+        json.dumps(ch)[1:-1].encode("ascii"),
+        json.dumps(ch, ensure_ascii=False)[1:-1].encode("utf-8"),
+    }
+
+
+def _bytes_literal_pattern(literal: str, ignorecase: bool) -> list[bytes]:
+    """Convert a literal to bytes regular expressions matching its JSON encoding
+
+    Under IGNORECASE, the literal is split at non-ASCII characters, because
+    their case variants can't be matched with a bytes regular expression."""
+    runs: list[bytes] = []
+    current: list[bytes] = []
+    for ch in literal:
+        if ignorecase and not ch.isascii():
+            runs.append(b"".join(current))
+            current.clear()
+            continue
+        forms = _json_forms(ch)
+        if ignorecase:
+            for extra in _ignorecase_extras.get(ch.lower(), ""):
+                forms |= _json_forms(extra)
+        if len(forms) == 1:
+            current.append(re.escape(forms.pop()))
+        else:
+            current.append(
+                b"(?:" + b"|".join(re.escape(f) for f in sorted(forms)) + b")"
+            )
+    runs.append(b"".join(current))
+    return [run for run in runs if run]
+
+
+def bytes_prefilter(rx: re.Pattern[str]) -> list[re.Pattern[bytes]]:
+    """Return bytes regular expressions that the raw bytes of a session file
+    must all match, if any message in it can match rx"""
+    ignorecase = bool(rx.flags & re.IGNORECASE)
+    return [
+        re.compile(p, re.IGNORECASE if ignorecase else 0)
+        for literal in required_literals(rx)
+        for p in _bytes_literal_pattern(literal, ignorecase)
+    ]
+
+
+def _matching_messages(
+    messages: Iterable[Message], rx: re.Pattern[str], first_only: bool
+) -> list[Message]:
+    result = []
+    for m in messages:
+        if isinstance(m.content, str) and rx.search(m.content):
+            result.append(m)
+            if first_only:
+                break
+    return result
+
+
+def scan_file(
+    path: pathlib.Path, pattern: str, flags: int, first_only: bool = False
+) -> Tuple[pathlib.Path, list[Message], Optional[str]]:
+    """Return the messages in path that match, and an error message if the
+    file could not be read
+
+    jsonl sessions are decompressed and checked one line at a time, so with
+    first_only the rest of the file is not read after the first match.
+
+    This runs in worker processes, so it takes the pattern rather than the
+    compiled expression (the re module caches compiled expressions)."""
+    rx = re.compile(pattern, flags)
+    prefilters = bytes_prefilter(rx)
+    try:
+        with open_session_file(path) as f:
+            if is_jsonl(path):
+                return (
+                    path,
+                    _matching_messages(
+                        (
+                            message_from_dict(json.loads(line))
+                            for line in f
+                            if line.strip() and all(p.search(line) for p in prefilters)
+                        ),
+                        rx,
+                        first_only,
+                    ),
+                    None,
+                )
+            data = f.read()
+        # A reference into the object store doesn't contain the messages
+        # themselves, so it can't be prefiltered
+        is_ref = data.startswith(b'{"first"')
+        if not is_ref and not all(p.search(data) for p in prefilters):
+            return path, [], None
+        session = session_from_json(data.decode("utf-8"), objects_path(path.parent))
+    except Exception as e:
+        return path, [], f"Failed to read {path}: {e}"
+    return path, _matching_messages(session, rx, first_only), None
+
+
+def scan_files(
+    paths: Iterable[pathlib.Path],
+    rx: re.Pattern[str],
+    jobs: int = 1,
+    first_only: bool = False,
+) -> Iterator[Tuple[pathlib.Path, Message]]:
+    """Yield each message that rx matches, in the order of sorted paths
+
+    Files are first checked with a cheap prefilter on their raw bytes, and
+    only decoded if they might match. With jobs other than 1, files are
+    scanned in that many worker processes (0 meaning one per CPU); results
+    are still yielded in order, as soon as they are available. With
+    first_only, at most one message is yielded per file."""
+    paths = sorted(paths)
+    results: Iterable[Tuple[pathlib.Path, list[Message], Optional[str]]]
+    executor = None
+    if jobs == 1 or len(paths) < 2:
+        results = (scan_file(path, rx.pattern, rx.flags, first_only) for path in paths)
+    else:
+        workers = jobs or os.cpu_count() or 1
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(
+            scan_file,
+            paths,
+            itertools.repeat(rx.pattern),
+            itertools.repeat(rx.flags),
+            itertools.repeat(first_only),
+            chunksize=max(1, min(64, len(paths) // (4 * workers))),
+        )
+    try:
+        for path, messages, error in results:
+            if error is not None:
+                print(error, file=sys.stderr)
+            for message in messages:
+                yield path, message
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+@functools.cache
+def fts5_available() -> bool:
+    try:
+        sqlite3.connect(":memory:").execute(
+            "CREATE VIRTUAL TABLE t USING fts5(c, tokenize='trigram')"
+        )
+    except sqlite3.Error:
+        return False
+    return True
+
+
+@dataclass
+class IndexStats:
+    hits: int = 0
+    """Files whose index entries were up to date"""
+
+    misses: int = 0
+    """Files which were (re-)indexed"""
+
+    removed: int = 0
+    """Files which no longer exist, and were dropped from the index"""
+
+    failed: int = 0
+    """Files which could not be read"""
+
+    candidates: int = 0
+    """Files with a message that could match the most recent search"""
+
+    def __str__(self) -> str:
+        return (
+            f"index: {self.hits} up to date, {self.misses} reindexed, "
+            f"{self.removed} removed, {self.failed} unreadable; "
+            f"{self.candidates} candidate files"
+        )
+
+
+class SearchIndex:
+    """A full text index of sessions, stored in an SQLite FTS5 database
+
+    Each message is stored with a trigram tokenizer, so that any literal of 3
+    or more characters can be looked up. Regular expressions are only run
+    against messages containing all of their required literals."""
+
+    def __init__(self, path: pathlib.Path = index_path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.stats = IndexStats()
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files"
+                " (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER)"
+            )
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5"
+                " (content, role UNINDEXED, file_id UNINDEXED, seq UNINDEXED,"
+                " tokenize='trigram')"
+            )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _forget(self, file_id: int) -> None:
+        self.db.execute("DELETE FROM messages WHERE file_id = ?", (file_id,))
+        self.db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def update(self, paths: Iterable[pathlib.Path], reindex: bool = False) -> None:
+        """Bring the index up to date with the given session files
+
+        Only files whose size or modification time changed since they were
+        last indexed are read. Indexed files not in paths are dropped."""
+        known = {
+            path: (file_id, size, mtime_ns)
+            for file_id, path, size, mtime_ns in self.db.execute(
+                "SELECT id, path, size, mtime_ns FROM files"
+            )
+        }
+        with self.db:
+            for path in paths:
+                key = str(path.absolute())
+                entry = known.pop(key, None)
+                try:
+                    size_mtime = session_file_stat(path)
+                except OSError:
+                    continue
+                if not reindex and entry is not None and entry[1:] == size_mtime:
+                    self.stats.hits += 1
+                    continue
+                if entry is not None:
+                    self._forget(entry[0])
+                try:
+                    session = session_from_file(path)
+                except Exception as e:
+                    print(f"Failed to read {path}: {e}", file=sys.stderr)
+                    self.stats.failed += 1
+                    continue
+                self.stats.misses += 1
+                file_id = self.db.execute(
+                    "INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                    (key, *size_mtime),
+                ).lastrowid
+                self.db.executemany(
+                    "INSERT INTO messages (content, role, file_id, seq)"
+                    " VALUES (?, ?, ?, ?)",
+                    (
+                        (message.content, message.role, file_id, seq)
+                        for seq, message in enumerate(session)
+                        if isinstance(message.content, str)
+                    ),
+                )
+            for file_id, _, _ in known.values():
+                self._forget(file_id)
+                self.stats.removed += 1
+
+    def search(self, rx: re.Pattern[str]) -> Iterator[Tuple[pathlib.Path, Message]]:
+        """Yield each indexed message that rx matches, grouped by file"""
+        literals = required_literals(rx)
+        if rx.flags & re.IGNORECASE:
+            literals = [run for s in literals for run in _ignorecase_mismatch.split(s)]
+        literals = [s for s in literals if len(s) >= MIN_INDEXED_LITERAL]
+        query = (
+            "SELECT f.path, m.role, m.content FROM messages m"
+            " JOIN files f ON f.id = m.file_id"
+        )
+        args: tuple[str, ...] = ()
+        if literals:
+            query += " WHERE messages MATCH ?"
+            args = (" AND ".join('"' + s.replace('"', '""') + '"' for s in literals),)
+        query += " ORDER BY f.path, m.seq"
+
+        last_path: Optional[str] = None
+        for path, role, content in self.db.execute(query, args):
+            if path != last_path:
+                self.stats.candidates += 1
+                last_path = path
+            if rx.search(content):
+                yield pathlib.Path(path), Message(role, content)
@@ -4,12 +4,37 @@
 
 from __future__ import annotations
 
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
 import json
+import os
 import pathlib
-from dataclasses import asdict, dataclass
-from typing import Union, cast
+import stat
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Iterator, Optional, Union, cast
 
-from typing_extensions import TypedDict
+from typing_extensions import NotRequired, TypedDict
+
+from .pack import find_packed, packed_paths, read_packed, write_pack
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, only needed for .zst sessions
+    zstandard = None  # type: ignore
 
 
 # not an enum.Enum because these objects are not json-serializable, sigh
@@ -23,11 +48,73 @@ class Role:
 class Message:
     """Represents one Message within a chap Session"""
 
+    # Sessions can hold a great many messages, so don't give each one a __dict__
+    __slots__ = (
+        "role",
+        "content",
+        "_tokens",
+        "_tokens_of",
+        "_tokens_unsaved",
+        "_summary",
+    )
+
     role: str
     content: str
 
+    def __post_init__(self) -> None:
+        # The number of tokens in the content, by the name of the encoding
+        # that counted them. They are only valid while the content is the
+        # string they were counted from. Not fields, so they aren't compared
+        # or shown.
+        self._tokens: Optional[dict[str, int]] = None
+        self._tokens_of: Optional[str] = None
+        # Whether counts were added since the message was loaded or saved
+        self._tokens_unsaved = False
+        self._summary: Optional[SummaryDict] = None
+
+    def token_counts(self) -> Optional[dict[str, int]]:
+        """Return the known token counts of the message, by encoding name"""
+        content = self.content  # first, since it may load a lazy message
+        if self._tokens_of is not content:
+            return None
+        return self._tokens
+
+    def unsaved_token_counts(self) -> Optional[dict[str, int]]:
+        """Return the token counts of the message if some were added since it
+        was loaded or saved"""
+        return self.token_counts() if self._tokens_unsaved else None
 
-MessageDict = TypedDict("MessageDict", {"role": str, "content": int})
+    def set_token_count(self, encoding: str, count: int) -> None:
+        content = self.content
+        if self._tokens is None or self._tokens_of is not content:
+            self._tokens = {}
+            self._tokens_of = content
+        self._tokens[encoding] = count
+        self._tokens_unsaved = True
+
+    def summary(self) -> Optional[SummaryDict]:
+        """Return the summary of earlier messages that was made when this
+        message was added (see summary.py)"""
+        self.content  # first, since it may load a lazy message
+        return self._summary
+
+    def set_summary(self, summary: SummaryDict) -> None:
+        self.content
+        self._summary = summary
+
+
+# A summary of the messages of a session from start up to (not including)
+# end, as kept with a later message
+SummaryDict = TypedDict("SummaryDict", {"start": int, "end": int, "content": str})
+MessageDict = TypedDict(
+    "MessageDict",
+    {
+        "role": str,
+        "content": str,
+        "tokens": NotRequired[dict[str, int]],
+        "summary": NotRequired[SummaryDict],
+    },
+)
 Session = list[Message]
 SessionDicts = list[MessageDict]
 
@@ -50,26 +137,951 @@ def new_session(
     return [System(system_message)]
 
 
+def message_to_dict(message: Message, with_tokens: bool = False) -> MessageDict:
+    """Convert a message to a dict, as sent to a backend or, with_tokens, as
+    stored in a session file (with its token counts and summary)"""
+    # much faster than dataclasses.asdict, which deep-copies the fields
+    result: MessageDict = {"role": message.role, "content": message.content}
+    if with_tokens:
+        if tokens := message.token_counts():
+            result["tokens"] = tokens
+        if summary := message.summary():
+            result["summary"] = summary
+    return result
+
+
+def message_from_dict(mapping: MessageDict) -> Message:
+    # The same few role strings are repeated in every message, so intern them
+    message = Message(sys.intern(mapping["role"]), mapping["content"])
+    if (tokens := mapping.get("tokens")) is not None:
+        message._tokens = tokens
+        message._tokens_of = message.content
+    message._summary = mapping.get("summary")
+    return message
+
+
+def unsaved_token_counts(messages: Session) -> dict[str, dict[str, int]]:
+    """Return the token counts of the messages that gained counts since
+    they were loaded or saved, by the content that was counted"""
+    return {
+        message.content: counts
+        for message in messages
+        if (counts := message.unsaved_token_counts())
+    }
+
+
+def add_token_counts(messages: Session, counts: dict[str, dict[str, int]]) -> None:
+    """Add counts (as returned by unsaved_token_counts) to the messages with
+    the same content, since a count only depends on the content"""
+    for message in messages:
+        if (new := counts.get(message.content)) is not None:
+            for encoding, n in new.items():
+                message.set_token_count(encoding, n)
+
+
+def mark_token_counts_saved(messages: Session) -> None:
+    for message in messages:
+        message._tokens_unsaved = False
+
+
 def session_to_json(session: Session) -> str:
-    return json.dumps(session_to_list(session))
+    return json.dumps([message_to_dict(message, True) for message in session])
 
 
 def session_to_list(session: Session) -> SessionDicts:
-    return [cast(MessageDict, asdict(message)) for message in session]
+    return [message_to_dict(message) for message in session]
 
 
-def session_from_json(data: str) -> Session:
+def session_from_json(data: str, objects: Optional[pathlib.Path] = None) -> Session:
+    """Load a session from json
+
+    If it is a reference to messages in an object store (see
+    session_to_ref_file), the store's location must be given."""
     j = json.loads(data)
     if isinstance(j, dict):
+        if "leaf" in j:
+            if objects is None:
+                raise ValueError("Session refers to an unknown object store")
+            return [message_from_dict(j["first"])] + load_objects(objects, j["leaf"])
         j = j["session"]
-    return [Message(**mapping) for mapping in j]
+    return [message_from_dict(mapping) for mapping in j]
+
+
+def message_to_jsonl(message: Message) -> str:
+    return json.dumps(message_to_dict(message, True)) + "\n"
+
+
+def session_to_jsonl(session: Session) -> str:
+    return "".join(message_to_jsonl(message) for message in session)
+
+
+def session_from_jsonl(
+    data: str, counts: Optional[dict[int, dict[str, int]]] = None
+) -> Session:
+    """Load a session from jsonl, adding the token counts saved separately
+    for its messages, by position (see _read_token_counts)"""
+    mappings = [json.loads(line) for line in data.splitlines() if line.strip()]
+    for i, new in (counts or {}).items():
+        if i < len(mappings):
+            _add_token_counts_to_dict(mappings[i], new)
+    return [message_from_dict(mapping) for mapping in mappings]
+
+
+class LazyMessage(Message):
+    """A message which is only read from storage when it is used"""
+
+    __slots__ = ("_read", "_role", "_content", "modified")
+
+    def __init__(self, read: Callable[[], MessageDict]) -> None:
+        # not calling super().__init__, because the fields are properties
+        self._read = read
+        self._role: Optional[str] = None
+        self._content: Optional[str] = None
+        self._tokens = None
+        self._tokens_of = None
+        self._tokens_unsaved = False
+        self._summary = None
+        self.modified = False
+
+    def _load(self) -> None:
+        self._set(self._read())
+
+    def _set(self, j: MessageDict) -> None:
+        self._role = sys.intern(j["role"])
+        self._content = j["content"]
+        if (tokens := j.get("tokens")) is not None:
+            self._tokens = tokens
+            self._tokens_of = self._content
+        self._summary = j.get("summary")
+
+    @property  # type: ignore[override]
+    def role(self) -> str:
+        if self._role is None:
+            self._load()
+        return cast(str, self._role)
+
+    @role.setter
+    def role(self, value: str) -> None:
+        if self._content is None:
+            self._load()
+        self._role = value
+        self.modified = True
+
+    @property  # type: ignore[override]
+    def content(self) -> str:
+        if self._content is None:
+            self._load()
+        return cast(str, self._content)
+
+    @content.setter
+    def content(self, value: str) -> None:
+        if self._role is None:
+            self._load()
+        self._content = value
+        self.modified = True
+
+
+def _jsonl_index_path(path: Union[pathlib.Path, str]) -> pathlib.Path:
+    path = pathlib.Path(path)
+    return path.parent / f".{path.name}.idx"
+
+
+# Token counts given to messages of a jsonl session after they were saved are
+# appended to a hidden file next to it, so that the session itself is only
+# ever appended to. Each line has the counts of some messages, by position,
+# and the inode of the session file they belong to; when the session is
+# replaced, its counts are written with its messages instead, and the
+# file is removed.
+def _jsonl_tokens_path(path: Union[pathlib.Path, str]) -> pathlib.Path:
+    path = pathlib.Path(path)
+    return path.parent / f".{path.name}.tokens"
+
+
+def _read_token_counts(
+    path: Union[pathlib.Path, str], ino: int
+) -> dict[int, dict[str, int]]:
+    counts: dict[int, dict[str, int]] = {}
+    try:
+        with open(_jsonl_tokens_path(path), "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # a line another process is still writing
+                    continue
+                if record.get("ino") == ino:
+                    for i, new in record["tokens"].items():
+                        counts.setdefault(int(i), {}).update(new)
+    except OSError:
+        pass
+    return counts
+
+
+def _append_token_counts(
+    path: Union[pathlib.Path, str], counts: dict[int, dict[str, int]]
+) -> None:
+    record = {"ino": os.stat(path).st_ino, "tokens": counts}
+    with open(_jsonl_tokens_path(path), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _add_token_counts_to_dict(mapping: MessageDict, counts: dict[str, int]) -> None:
+    mapping["tokens"] = {**mapping.get("tokens", {}), **counts}
+
+
+# Saving a session is serialized by a lock on one byte of a hidden file in
+# its directory, chosen by the session's name, so that saving one session
+# doesn't wait for saves of the others. Sessions aren't locked themselves:
+# they can be replaced by renaming a new file over them (which Windows
+# refuses for an open file), and a lock file per session would double the
+# size of the directory.
+lock_file_name = ".lock"
+
+
+class _HeldLock:
+    # A session lock as used by the threads of this process
+    def __init__(self) -> None:
+        self.mutex = threading.RLock()
+        self.users = 0
+        self.depth = 0
+
+
+# The session locks used by this process, and the lock files it has open,
+# with how many locks are held on each. Byte-range locks belong to the
+# process, and closing any descriptor of a file releases all of them, so each
+# lock file is opened once while locks are held on it.
+_held_locks: dict[pathlib.Path, _HeldLock] = {}
+_lock_files: dict[pathlib.Path, tuple[int, int]] = {}
+_held_locks_mutex = threading.Lock()
+
+
+def _lock_path(path: Union[pathlib.Path, str]) -> pathlib.Path:
+    return pathlib.Path(path).absolute().parent / lock_file_name
+
+
+def _open_lock_file(lock_path: pathlib.Path) -> int:
+    with _held_locks_mutex:
+        fd, n = _lock_files.get(lock_path, (-1, 0))
+        if fd < 0:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        _lock_files[lock_path] = (fd, n + 1)
+        return fd
+
+
+def _close_lock_file(lock_path: pathlib.Path) -> None:
+    with _held_locks_mutex:
+        fd, n = _lock_files.pop(lock_path)
+        if n > 1:
+            _lock_files[lock_path] = (fd, n - 1)
+        else:
+            os.close(fd)
+
+
+@contextlib.contextmanager
+def _lock_byte(path: pathlib.Path) -> Iterator[None]:
+    lock_path = _lock_path(path)
+    offset = zlib.crc32(os.fsencode(path.name))
+    fd = _open_lock_file(lock_path)
+    try:
+        if sys.platform == "win32":
+            # The file position is shared by the threads locking other bytes
+            while True:
+                with _held_locks_mutex:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        pass
+                time.sleep(0.01)
+            try:
+                yield
+            finally:
+                with _held_locks_mutex:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset, os.SEEK_SET)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset, os.SEEK_SET)
+    finally:
+        _close_lock_file(lock_path)
+
+
+@contextlib.contextmanager
+def session_lock(path: Union[pathlib.Path, str]) -> Iterator[None]:
+    """Hold an exclusive lock on saving the session at path
+
+    Other sessions, even in the same directory, can be saved meanwhile. The
+    lock may be taken again by the thread holding it."""
+    path = pathlib.Path(path).absolute()
+    with _held_locks_mutex:
+        held = _held_locks.setdefault(path, _HeldLock())
+        held.users += 1
+    try:
+        with held.mutex:
+            held.depth += 1
+            try:
+                with _lock_byte(path) if held.depth == 1 else contextlib.nullcontext():
+                    yield
+            finally:
+                held.depth -= 1
+    finally:
+        with _held_locks_mutex:
+            held.users -= 1
+            if not held.users:
+                del _held_locks[path]
+
+
+def _scan_line_ends(f: BinaryIO, start: int, ends: "array[int]") -> None:
+    f.seek(start)
+    pos = start
+    while chunk := f.read(1 << 20):
+        i = chunk.find(b"\n")
+        while i != -1:
+            ends.append(pos + i + 1)
+            i = chunk.find(b"\n", i + 1)
+        pos += len(chunk)
+
+
+def jsonl_line_ends(path: Union[pathlib.Path, str], f: BinaryIO) -> "array[int]":
+    """Return the offset just past each complete line of a jsonl session
+
+    The offsets are cached in a hidden index file next to the session, along
+    with the session file's size, modification time and inode. When the
+    session was only appended to, just the new part of the file is scanned."""
+    st = os.fstat(f.fileno())
+    index_path = _jsonl_index_path(path)
+    ends = array("Q")
+    try:
+        with open(index_path, "rb") as idx:
+            ends.frombytes(idx.read())
+    except (OSError, ValueError):
+        ends = array("Q")
+    if len(ends) >= 3:
+        size, mtime_ns, ino = ends[:3]
+        del ends[:3]
+        if (size, mtime_ns, ino) == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return ends
+        if ino != st.st_ino or size > st.st_size or (ends and ends[-1] > size):
+            del ends[:]
+    else:
+        del ends[:]
+
+    _scan_line_ends(f, ends[-1] if ends else 0, ends)
+    try:
+        with open(index_path, "wb") as idx:
+            array("Q", (st.st_size, st.st_mtime_ns, st.st_ino)).tofile(idx)
+            ends.tofile(idx)
+    except OSError:
+        pass
+    return ends
+
+
+# How much more of a jsonl session to read with each lazily loaded message
+jsonl_read_ahead = 1 << 16
+
+
+class _JsonlReader:
+    """Reads the messages of a lazily loaded jsonl session
+
+    The file is opened again for each read, rather than kept open, so that
+    it can be replaced (on Windows, an open file can't be). Each read also
+    loads the messages after the one asked for, up to jsonl_read_ahead bytes,
+    since they are often used next."""
+
+    def __init__(
+        self,
+        path: Union[pathlib.Path, str],
+        ino: int,
+        counts: dict[int, dict[str, int]],
+    ) -> None:
+        self.path = path
+        self.ino = ino
+        self.counts = counts
+        self.messages: list[LazyMessage] = []
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+
+    def add(self, start: int, end: int) -> LazyMessage:
+        message = LazyMessage(functools.partial(self.read, len(self.messages)))
+        self.messages.append(message)
+        self.starts.append(start)
+        self.ends.append(end)
+        return message
+
+    def read(self, i: int) -> MessageDict:
+        start = self.starts[i]
+        j = i + 1
+        while (
+            j < len(self.messages)
+            and self.ends[j] - start <= jsonl_read_ahead
+            and self.messages[j]._role is None
+            and self.messages[j]._content is None
+        ):
+            j += 1
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_ino != self.ino:
+                raise ValueError(
+                    f"Session {self.path} was replaced since it was opened"
+                )
+            f.seek(start)
+            data = f.read(self.ends[j - 1] - start)
+        for k in range(i + 1, j):
+            line = data[self.starts[k] - start : self.ends[k] - start]
+            self.messages[k]._set(self._mapping(k, line))
+        return self._mapping(i, data[: self.ends[i] - start])
+
+    def _mapping(self, i: int, line: bytes) -> MessageDict:
+        mapping = cast(MessageDict, json.loads(line))
+        if (counts := self.counts.get(i)) is not None:
+            _add_token_counts_to_dict(mapping, counts)
+        return mapping
+
+
+def lazy_session_from_jsonl_file(path: Union[pathlib.Path, str]) -> Session:
+    """Open a jsonl session without reading its messages
+
+    Each message is read from the file the first time its role or content is
+    accessed (see _JsonlReader), so using just the system message and the
+    last few turns of a very long session only reads those parts of the
+    file."""
+    with open(path, "rb") as f:
+        ends = jsonl_line_ends(path, f)
+        ino = os.fstat(f.fileno()).st_ino
+        reader = _JsonlReader(path, ino, _read_token_counts(path, ino))
+    session: Session = []
+    start = 0
+    for end in ends:
+        # Skip blank lines
+        if end - start > 1:
+            session.append(reader.add(start, end))
+        start = end
+    return session
+
+
+# The formats a session can be stored in; each is also its filename suffix
+session_formats = ("json", "jsonl", "json.gz", "jsonl.gz", "json.zst", "jsonl.zst")
+session_suffixes = tuple(f".{fmt}" for fmt in session_formats)
+compression_suffixes = (".gz", ".zst")
+
+
+def compression_of(path: Union[pathlib.Path, str]) -> str:
+    """Return the compression suffix of path, or the empty string"""
+    for suffix in compression_suffixes:
+        if str(path).endswith(suffix):
+            return suffix
+    return ""
 
 
-def session_from_file(path: Union[pathlib.Path, str]) -> Session:
-    with open(path, "r", encoding="utf-8") as f:
-        return session_from_json(f.read())
+def is_jsonl(path: Union[pathlib.Path, str]) -> bool:
+    return str(path).removesuffix(compression_of(path)).endswith(".jsonl")
+
+
+def open_session_file(
+    path: Union[pathlib.Path, str], mode: str = "rb", compression: Optional[str] = None
+) -> BinaryIO:
+    """Open a session file in binary mode, (de)compressing it as its name implies
+
+    Reading decompresses as a stream. Appending to a compressed file adds a
+    new gzip member or zstd frame, which readers treat as a continuation."""
+    if compression is None:
+        compression = compression_of(path)
+    if "r" in mode and not os.path.exists(path):
+        return _open_packed_session(path, compression)
+    if compression == ".gz":
+        return cast(BinaryIO, gzip.open(path, mode))
+    if compression == ".zst":
+        if zstandard is None:
+            raise ModuleNotFoundError(
+                f"Install the 'zstandard' package to use compressed session {path}"
+            )
+        if "r" in mode:
+            return cast(
+                BinaryIO,
+                io.BufferedReader(
+                    zstandard.ZstdDecompressor().stream_reader(
+                        open(path, "rb"), read_across_frames=True, closefd=True
+                    )
+                ),
+            )
+        return cast(
+            BinaryIO,
+            zstandard.ZstdCompressor().stream_writer(open(path, mode), closefd=True),
+        )
+    return cast(BinaryIO, open(path, mode))
+
+
+def compress_session_file(path: pathlib.Path, compression: str) -> pathlib.Path:
+    """Replace an uncompressed session file with a compressed copy
+
+    The copy keeps the original's permissions and modification time, so the
+    order of recent sessions is unchanged. It is made while holding the
+    session's lock, so that no message appended meanwhile is lost. Returns
+    the new path."""
+    new_path = path.with_name(path.name + compression)
+    with session_lock(path):
+        st = path.stat()
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".chap", suffix=".tmp")
+        os.close(fd)
+        try:
+            with open(path, "rb") as src:
+                with open_session_file(tmp, "wb", compression) as dst:
+                    while chunk := src.read(1 << 20):
+                        dst.write(chunk)
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp, new_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        path.unlink()
+        _jsonl_index_path(path).unlink(missing_ok=True)
+        if counts := _read_token_counts(path, st.st_ino):
+            _append_token_counts(new_path, counts)
+        _jsonl_tokens_path(path).unlink(missing_ok=True)
+    return new_path
+
+
+def _open_packed_session(path: Union[pathlib.Path, str], compression: str) -> BinaryIO:
+    f = io.BytesIO(read_packed(path))
+    if compression == ".gz":
+        return cast(BinaryIO, gzip.GzipFile(fileobj=f))
+    if compression == ".zst":
+        if zstandard is None:
+            raise ModuleNotFoundError(
+                f"Install the 'zstandard' package to use compressed session {path}"
+            )
+        return cast(
+            BinaryIO,
+            io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            ),
+        )
+    return f
+
+
+def session_exists(path: Union[pathlib.Path, str]) -> bool:
+    return os.path.exists(path) or find_packed(path) is not None
+
+
+def session_file_stat(path: Union[pathlib.Path, str]) -> tuple[int, int]:
+    """Return the size and modification time of a session, which may be packed"""
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except FileNotFoundError:
+        entry = find_packed(path)
+        if entry is None:
+            raise
+        return entry.size, entry.mtime_ns
+
+
+def pack_session_files(
+    directory: pathlib.Path, paths: list[pathlib.Path]
+) -> pathlib.Path:
+    """Move sessions into a new pack file; see pack.py
+
+    The sessions' locks are held until they have been removed, so that no
+    message appended meanwhile is lost. They are taken in order of path, as
+    another pack_session_files may be taking some of them too."""
+    paths = sorted(paths)
+    with contextlib.ExitStack() as stack:
+        for path in paths:
+            stack.enter_context(session_lock(path))
+        pack = write_pack(directory, paths)
+        for path in paths:
+            # Token counts that weren't saved in the session are counted
+            # again if they are needed
+            _jsonl_index_path(path).unlink(missing_ok=True)
+            _jsonl_tokens_path(path).unlink(missing_ok=True)
+    return pack
+
+
+def session_files(directory: pathlib.Path) -> Iterator[pathlib.Path]:
+    for suffix in session_suffixes:
+        for path in directory.glob(f"*{suffix}"):
+            # skip chap's own bookkeeping files, like the recent manifest
+            if not path.name.startswith("."):
+                yield path
+
+
+def all_session_paths(directory: pathlib.Path) -> list[pathlib.Path]:
+    """Return the paths of all sessions in directory, including packed ones"""
+    return list(session_files(directory)) + packed_paths(directory)
+
+
+# Each directory that sessions are saved in has a small manifest of the most
+# recently saved sessions, newest first, so that finding them doesn't need to
+# list and stat the whole directory
+recent_manifest_name = ".recent.json"
+recent_manifest_size = 100
+
+
+def write_recent_manifest(directory: pathlib.Path, names: list[str]) -> None:
+    manifest = directory / recent_manifest_name
+    data = json.dumps(names[:recent_manifest_size]).encode("utf-8")
+    _write_atomically(manifest, data)
+    # Ensure the manifest is at least as new as the directory entry changes
+    # made above, so that read_recent_manifest can detect files added later
+    os.utime(manifest)
+
+
+def read_recent_manifest(
+    directory: pathlib.Path, check_fresh: bool = True
+) -> Optional[list[str]]:
+    """Return the manifest's names, or None if it is missing or stale"""
+    manifest = directory / recent_manifest_name
+    try:
+        # If a file was created, renamed or removed since the manifest was
+        # written, the directory is newer than the manifest
+        if check_fresh and directory.stat().st_mtime_ns > manifest.stat().st_mtime_ns:
+            return None
+        with open(manifest, encoding="utf-8") as f:
+            names = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(names, list):
+        return None
+    return names
+
+
+def rebuild_recent_manifest(directory: pathlib.Path) -> list[str]:
+    with session_lock(directory / recent_manifest_name):
+        paths = sorted(
+            session_files(directory), key=lambda p: p.stat().st_mtime, reverse=True
+        )
+        names = [p.name for p in paths[:recent_manifest_size]]
+        try:
+            write_recent_manifest(directory, names)
+        except OSError:
+            pass
+    return names
+
+
+def record_recent_session(path: Union[pathlib.Path, str]) -> None:
+    """Move path to the front of its directory's manifest, if there is one
+
+    The manifest is created the first time the recent sessions in a directory
+    are looked up, so saving sessions elsewhere doesn't leave manifests
+    behind. The session was just created or modified by this process, so the
+    manifest is updated even if the directory is newer than it.
+
+    The manifest is updated under its own lock, so that concurrent saves
+    don't lose each other's entries. If two sessions saved at once are
+    recorded in the other order, the manifest no longer starts with the
+    newest session, and is rebuilt the next time it is read."""
+    path = pathlib.Path(path)
+    directory = path.parent
+    with session_lock(directory / recent_manifest_name):
+        names = read_recent_manifest(directory, check_fresh=False)
+        if names is None:
+            return
+        names = [path.name] + [n for n in names if n != path.name]
+        try:
+            write_recent_manifest(directory, names)
+        except OSError:
+            pass
+
+
+def _manifest_is_current(directory: pathlib.Path, paths: list[pathlib.Path]) -> bool:
+    # The first session of the manifest must be the newest of those it lists,
+    # and not newer than the manifest itself; otherwise some session was
+    # saved without updating it
+    try:
+        manifest_mtime = (directory / recent_manifest_name).stat().st_mtime_ns
+        mtimes = [p.stat().st_mtime_ns for p in paths]
+    except OSError:
+        return False
+    return not mtimes or max(mtimes) == mtimes[0] <= manifest_mtime
+
+
+def recent_session_paths(directory: pathlib.Path, n: int) -> list[pathlib.Path]:
+    """Return up to n of the most recently saved sessions in directory, newest first
+
+    Usually this only needs to consult the manifest. If the manifest is
+    missing or stale, the directory is scanned and the manifest is rebuilt."""
+    names = read_recent_manifest(directory)
+    if names is not None:
+        # Check at least two sessions, to see that the first is the newest
+        paths = [directory / name for name in names[: max(n, 2)]]
+        if _manifest_is_current(directory, paths):
+            return paths[:n]
+    names = rebuild_recent_manifest(directory)
+    return [directory / name for name in names[:n]]
+
+
+# What a session looked like when it was loaded or saved. Unmodified lazy
+# messages are compared by identity, to avoid reading them.
+Snapshot = list[tuple[Message, Optional[str], Optional[str]]]
+
+
+def _snapshot(message: Message) -> tuple[Message, Optional[str], Optional[str]]:
+    if isinstance(message, LazyMessage) and not message.modified:
+        return (message, None, None)
+    return (message, message.role, message.content)
+
+
+def session_snapshot(session: Session) -> Snapshot:
+    return [_snapshot(m) for m in session]
+
+
+def snapshot_is_prefix_of(snapshot: Snapshot, session: Session) -> bool:
+    """True if the session still begins with the snapshotted messages"""
+    if len(session) < len(snapshot):
+        return False
+    for message, (saved, role, content) in zip(session, snapshot):
+        if (
+            message is saved
+            and isinstance(message, LazyMessage)
+            and not message.modified
+        ):
+            continue
+        # The string comparisons are usually identity checks, since the
+        # snapshot refers to the same string objects as the session itself
+        if message.role != role or message.content != content:
+            return False
+    return True
+
+
+@dataclass
+class SavedState:
+    """What is known to be on disk for a session file loaded or saved by this process"""
+
+    size: int
+    mtime_ns: int
+    messages: Snapshot
+
+    def is_prefix_of(self, session: Session) -> bool:
+        return snapshot_is_prefix_of(self.messages, session)
+
+
+_saved_states: dict[str, SavedState] = {}
+
+
+def _remember_saved_state(
+    path: Union[pathlib.Path, str], session: Session, f: Union[int, str, pathlib.Path]
+) -> None:
+    try:
+        st = os.stat(f)
+    except FileNotFoundError:
+        # A packed session; saving it will write a new, ordinary file
+        return
+    _saved_states[os.path.abspath(path)] = SavedState(
+        st.st_size, st.st_mtime_ns, session_snapshot(session)
+    )
+
+
+@functools.cache
+def _umask() -> int:
+    # The umask can only be read by setting it
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+
+def _file_mode(path: Union[pathlib.Path, str]) -> int:
+    """Return the permissions of the file at path, or those a new file would get"""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_umask()
+
+
+def _write_atomically(
+    path: Union[pathlib.Path, str], data: bytes, compression: str = ""
+) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".chap", suffix=".tmp")
+    os.close(fd)
+    try:
+        # mkstemp makes the file private; give it the mode the file it
+        # replaces had, or would have had if created directly
+        os.chmod(tmp, _file_mode(path))
+        with open_session_file(tmp, "wb", compression) as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# Sessions that share a history, like the branches of an imported
+# conversation or the copies the tui saves before redrafting, can be stored as
+# a chain of content-addressed messages in a directory's object store. Each
+# message's object holds the hash of the message before it, so a common
+# prefix is only stored once. The session file itself then just holds the
+# first (system) message, which often differs between the branches, and the
+# hash of the last message.
+objects_directory_name = ".objects"
+
+
+def objects_path(directory: pathlib.Path) -> pathlib.Path:
+    return directory / objects_directory_name
+
+
+def _object_path(objects: pathlib.Path, key: str) -> pathlib.Path:
+    return objects / key[:2] / key[2:]
+
+
+def _object_key(parent: Optional[str], message: Message) -> str:
+    h = hashlib.sha256()
+    h.update((parent or "").encode("ascii"))
+    h.update(json.dumps(message_to_dict(message)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def store_objects(objects: pathlib.Path, messages: Session) -> Optional[str]:
+    """Store messages as a chain in the object store, returning the key of the last
+
+    Only the messages not already in the store are written: once the object
+    for a message exists, all the ones before it do too."""
+    keys: list[str] = []
+    parent: Optional[str] = None
+    for message in messages:
+        parent = _object_key(parent, message)
+        keys.append(parent)
+
+    first_new = len(keys)
+    while first_new > 0 and not _object_path(objects, keys[first_new - 1]).exists():
+        first_new -= 1
+
+    for i in range(first_new, len(keys)):
+        path = _object_path(objects, keys[i])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        message = messages[i]
+        mapping = {
+            "parent": keys[i - 1] if i else None,
+            "role": message.role,
+            "content": message.content,
+        }
+        _write_atomically(path, json.dumps(mapping).encode("utf-8"))
+
+    return parent
+
+
+def load_objects(objects: pathlib.Path, key: Optional[str]) -> Session:
+    """Load the chain of messages ending with key from the object store"""
+    result = []
+    while key is not None:
+        with open(_object_path(objects, key), "rb") as f:
+            mapping = json.load(f)
+        result.append(message_from_dict(mapping))
+        key = mapping["parent"]
+    result.reverse()
+    return result
+
+
+def session_to_ref_file(session: Session, path: Union[pathlib.Path, str]) -> None:
+    """Save a session into the object store of the directory containing path
+
+    The file at path refers to the stored messages, and can be loaded by
+    session_from_file like any other session."""
+    path = pathlib.Path(path)
+    if compression_of(path) or is_jsonl(path):
+        raise ValueError(f"Session references must be plain json, not {path}")
+    leaf = store_objects(objects_path(path.parent), session[1:])
+    ref = {"first": message_to_dict(session[0]), "leaf": leaf}
+    with session_lock(path):
+        _write_atomically(path, json.dumps(ref).encode("utf-8"))
+        record_recent_session(path)
+
+
+def session_from_file(path: Union[pathlib.Path, str], lazy: bool = False) -> Session:
+    """Load a session
+
+    If lazy is true and the session is in the uncompressed jsonl format,
+    messages are read from the file on demand (see
+    lazy_session_from_jsonl_file)."""
+    if lazy and is_jsonl(path) and not compression_of(path) and os.path.exists(path):
+        session = lazy_session_from_jsonl_file(path)
+        _remember_saved_state(path, session, path)
+        return session
+    try:
+        ino: Optional[int] = os.stat(path).st_ino
+    except FileNotFoundError:  # a packed session
+        ino = None
+    with open_session_file(path) as f:
+        data = f.read().decode("utf-8")
+    if is_jsonl(path):
+        counts = None
+        # The counts are only those of the file that was read
+        if ino is not None and os.stat(path).st_ino == ino:
+            counts = _read_token_counts(path, ino)
+        session = session_from_jsonl(data, counts)
+    else:
+        session = session_from_json(data, objects_path(pathlib.Path(path).parent))
+    _remember_saved_state(path, session, path)
+    return session
 
 
 def session_to_file(session: Session, path: Union[pathlib.Path, str]) -> None:
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(session_to_json(session))
+    """Save a session
+
+    Several processes can add to the same session at once, for instance with
+    'chap ask --last' in more than one shell. While holding the session's
+    lock, the messages added since this process loaded or saved it are added
+    to what is in the file now, even if another process has added to it in
+    the meantime: jsonl sessions are appended to, other formats are re-read
+    and rewritten. If earlier messages were changed, as by redrafting in the
+    tui, the file is replaced with the session instead."""
+    with session_lock(path):
+        if is_jsonl(path):
+            session_to_jsonl_file(session, path)
+        else:
+            data = session
+            state = _saved_states.get(os.path.abspath(path))
+            if (
+                state is not None
+                and os.path.exists(path)
+                and state.is_prefix_of(session)
+            ):
+                # The file may hold other processes' messages too, and the
+                # messages it shares with this session may have been
+                # counted since
+                old = len(state.messages)
+                data = session_from_file(path)
+                add_token_counts(data, unsaved_token_counts(session[:old]))
+                data += session[old:]
+            _write_atomically(
+                path, session_to_json(data).encode("utf-8"), compression_of(path)
+            )
+            _remember_saved_state(path, session, path)
+            mark_token_counts_saved(session)
+        record_recent_session(path)
+
+
+def session_to_jsonl_file(session: Session, path: Union[pathlib.Path, str]) -> None:
+    """Save a session in the append-only format
+
+    When the messages this process last loaded or saved are an unchanged
+    prefix of the session, only the new messages are appended, even if other
+    processes have appended to the file since, and token counts the saved
+    messages were given since are appended to a hidden file next to it (see
+    _jsonl_tokens_path). Otherwise, the whole file is replaced, with the
+    counts of all its messages.
+
+    Callers that may race with other processes should hold session_lock."""
+    state = _saved_states.get(os.path.abspath(path))
+    if state is not None and os.path.exists(path) and state.is_prefix_of(session):
+        old = len(state.messages)
+        counts = {
+            i: new
+            for i, message in enumerate(session[:old])
+            if (new := message.unsaved_token_counts())
+        }
+        if counts:
+            _append_token_counts(path, counts)
+        with open_session_file(path, "ab") as f:
+            f.write(session_to_jsonl(session[old:]).encode("utf-8"))
+        _remember_saved_state(path, session, path)
+        mark_token_counts_saved(session)
+        return
+
+    _write_atomically(
+        path, session_to_jsonl(session).encode("utf-8"), compression_of(path)
+    )
+    _jsonl_tokens_path(path).unlink(missing_ok=True)
+    _remember_saved_state(path, session, path)
+    mark_token_counts_saved(session)
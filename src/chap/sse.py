@@ -0,0 +1,167 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Callable
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, only faster
+    orjson = None  # type: ignore
+
+# Streaming backends receive their responses as server-sent events
+# (https://html.spec.whatwg.org/multipage/server-sent-events.html): each
+# event is some "field: value" lines ending with an empty line. Servers
+# send nearly every event as a single "data:" line, so a chunk of the
+# response is split into events with bytes operations, and only the other
+# events are parsed field by field. The events of a chunk are found in one
+# go, so the asyncio machinery is paid for once per chunk, not per event.
+
+
+_raw_decode = json.JSONDecoder().raw_decode
+
+
+def _decode_json(data: bytes) -> Any:
+    # The json module decodes str faster than bytes, and raw_decode skips
+    # json.loads's checks for whitespace around the value
+    return _raw_decode(data.decode("utf-8").lstrip())[0]
+
+
+loads: Callable[[bytes], Any] = _decode_json if orjson is None else orjson.loads
+
+
+def _value(line: bytes, start: int) -> bytes:
+    # The value of a field, which starts after its name and colon, and
+    # maybe a space
+    return line[start + 1 :] if line[start : start + 1] == b" " else line[start:]
+
+
+def _parse_event(block: bytes) -> tuple[str, bytes] | None:
+    # An event with more than a single data line
+    event = b"message"
+    data: list[bytes] = []
+    for line in block.split(b"\n"):
+        name, colon, value = line.partition(b":")
+        if not colon:
+            # A line without a colon is a field with an empty value
+            value = b""
+        elif not name:
+            # A comment
+            continue
+        if value.startswith(b" "):
+            value = value[1:]
+        if name == b"data":
+            data.append(value)
+        elif name == b"event":
+            event = value or b"message"
+    if not data:
+        return None
+    return event.decode("utf-8", "replace"), b"\n".join(data)
+
+
+class EventParser:
+    """Splits an event stream, given in chunks of bytes, into events
+
+    Each event is given as its name ("message" unless the event names
+    another) and its data (the values of all its "data" fields, joined by
+    newlines). Events without data are left out, as are the id and retry
+    fields, since chap doesn't reconnect."""
+
+    def __init__(self) -> None:
+        self.pending = b""
+
+    def feed(self, chunk: bytes) -> list[tuple[str, bytes]]:
+        """Return the events completed by chunk"""
+        if self.pending:
+            chunk = self.pending + chunk
+        if b"\r" in chunk:
+            # A CR at the end may be the first half of a CRLF
+            if chunk.endswith(b"\r"):
+                self.pending = chunk
+                return []
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        blocks = chunk.split(b"\n\n")
+        self.pending = blocks.pop()
+        if chunk.count(b"\n") == 2 * len(blocks):
+            # No event (or the rest of the chunk) has a line break of its own,
+            # so each is a single line, and nearly always a data line
+            events = [
+                ("message", block[6:] if block[5:6] == b" " else block[5:])
+                for block in blocks
+                if block[:5] == b"data:"
+            ]
+            if len(events) == len(blocks):
+                return events
+        elif chunk.count(b"\n") == 3 * len(blocks):
+            # Maybe each event is an event line and a data line, as Anthropic
+            # sends them
+            pairs = [block.split(b"\n") for block in blocks]
+            events = [
+                (pair[0][7:].decode("utf-8", "replace"), _value(pair[1], 5))
+                for pair in pairs
+                if len(pair) == 2
+                and pair[0][:7] == b"event: "
+                and len(pair[0]) > 7
+                and pair[1][:5] == b"data:"
+            ]
+            if len(events) == len(blocks):
+                return events
+        events = []
+        append = events.append
+        for block in blocks:
+            if b"\n" not in block and block[:5] == b"data:":
+                append(("message", _value(block, 5)))
+            elif (
+                block.startswith(b"event:")
+                and block.count(b"\n") == 1
+                and b"\ndata:" in block
+            ):
+                # A named event with a single data line, as Anthropic sends
+                name, _, data = block.partition(b"\n")
+                name = _value(name, 6) or b"message"
+                append((name.decode("utf-8", "replace"), _value(data, 5)))
+            elif (event := _parse_event(block.lstrip(b"\n"))) is not None:
+                append(event)
+        return events
+
+    def close(self) -> list[tuple[str, bytes]]:
+        """Return the events left when the stream ends, which may end without
+        an empty line after its last event"""
+        events = self.feed(b"\n\n")
+        self.pending = b""
+        return events
+
+
+async def aiter_events(
+    chunks: AsyncIterable[bytes],
+) -> AsyncIterator[tuple[str, bytes]]:
+    """Yield each event of an event stream, given as chunks of bytes (such as
+    an httpx response's aiter_bytes()), as its name and data (see
+    EventParser)"""
+    parser = EventParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event
+
+
+async def aiter_json(
+    chunks: AsyncIterable[bytes], done: bytes = b"[DONE]"
+) -> AsyncIterator[tuple[str, Any]]:
+    """Like aiter_events, but with the data of each event decoded as JSON
+
+    Events whose data is done (which OpenAI-style servers send last) are
+    skipped, and the rest of the stream is still read, so that its
+    connection can be used again."""
+    parser = EventParser()
+    async for chunk in chunks:
+        for event, data in parser.feed(chunk):
+            if data != done:
+                yield event, loads(data)
+    for event, data in parser.close():
+        if data != done:
+            yield event, loads(data)
@@ -0,0 +1,375 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import datetime
+import functools
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import time
+from typing import Iterator, Optional, Tuple
+
+from typing_extensions import Protocol
+
+from .search import required_literals, scan_files
+from .session import (
+    LazyMessage,
+    Message,
+    MessageDict,
+    Session,
+    Snapshot,
+    all_session_paths,
+    mark_token_counts_saved,
+    message_from_dict,
+    recent_session_paths,
+    session_exists,
+    session_from_file,
+    session_snapshot,
+    session_to_file,
+    session_to_ref_file,
+    snapshot_is_prefix_of,
+)
+
+
+def new_session_name() -> str:
+    return datetime.datetime.now().isoformat().replace(":", "_")
+
+
+class StorageEngine(Protocol):
+    """Where sessions are kept
+
+    Every engine addresses a session by a path, whose parent is the directory
+    the session belongs to and whose name identifies it within that directory.
+    Depending on the engine, the path need not name a file."""
+
+    def session_paths(self, directory: pathlib.Path) -> list[pathlib.Path]:
+        """Return all the sessions in directory"""
+
+    def recent_session_paths(
+        self, directory: pathlib.Path, n: int
+    ) -> list[pathlib.Path]:
+        """Return up to n of the most recently saved sessions in directory, newest first"""
+
+    def new_session_path(
+        self, directory: pathlib.Path, session_format: str = "json"
+    ) -> pathlib.Path:
+        """Return a path for a new session in directory"""
+
+    def exists(self, path: pathlib.Path) -> bool:
+        """True if there is a session at path"""
+
+    def load(self, path: pathlib.Path, lazy: bool = False) -> Session:
+        """Load a session, raising FileNotFoundError if it does not exist
+
+        With lazy, messages may not be read until they are used."""
+
+    def save(self, session: Session, path: pathlib.Path) -> None:
+        """Save a session, appending to what is stored when possible"""
+
+    def save_copy(self, session: Session, path: pathlib.Path) -> None:
+        """Save a session which probably shares most of its history with others"""
+
+    def search(
+        self,
+        directory: pathlib.Path,
+        rx: re.Pattern[str],
+        jobs: int = 1,
+        first_only: bool = False,
+    ) -> Iterator[Tuple[pathlib.Path, Message]]:
+        """Yield each message in directory that rx matches, grouped by session"""
+
+
+class FileStorage:
+    """Each session is a file (see session.py for the formats)"""
+
+    def session_paths(self, directory: pathlib.Path) -> list[pathlib.Path]:
+        return all_session_paths(directory)
+
+    def recent_session_paths(
+        self, directory: pathlib.Path, n: int
+    ) -> list[pathlib.Path]:
+        return recent_session_paths(directory, n)
+
+    def new_session_path(
+        self, directory: pathlib.Path, session_format: str = "json"
+    ) -> pathlib.Path:
+        return directory / f"{new_session_name()}.{session_format}"
+
+    def exists(self, path: pathlib.Path) -> bool:
+        return session_exists(path)
+
+    def load(self, path: pathlib.Path, lazy: bool = False) -> Session:
+        return session_from_file(path, lazy=lazy)
+
+    def save(self, session: Session, path: pathlib.Path) -> None:
+        session_to_file(session, path)
+
+    def save_copy(self, session: Session, path: pathlib.Path) -> None:
+        if path.suffix == ".json":
+            session_to_ref_file(session, path)
+        else:
+            session_to_file(session, path)
+
+    def search(
+        self,
+        directory: pathlib.Path,
+        rx: re.Pattern[str],
+        jobs: int = 1,
+        first_only: bool = False,
+    ) -> Iterator[Tuple[pathlib.Path, Message]]:
+        return scan_files(all_session_paths(directory), rx, jobs, first_only)
+
+
+class SqliteStorage:
+    """All the sessions of a directory are rows in one SQLite database
+
+    Messages are stored one per row, keyed by their session and their position
+    in it, so listing sessions, appending a turn to a session, and reading
+    any one message are all indexed queries."""
+
+    database_name = "sessions.sqlite3"
+
+    def __init__(self) -> None:
+        self._connections: dict[str, sqlite3.Connection] = {}
+        # What each session looked like when this process last loaded or saved
+        # it, and the seq of each of its messages' rows
+        self._saved: dict[Tuple[str, str], Snapshot] = {}
+        self._seqs: dict[Tuple[str, str], list[int]] = {}
+
+    def _connect(
+        self, directory: pathlib.Path, create: bool = False
+    ) -> Optional[sqlite3.Connection]:
+        database = os.path.abspath(directory / self.database_name)
+        db = self._connections.get(database)
+        if db is not None:
+            return db
+        if not create and not os.path.exists(database):
+            return None
+        # Writers wait for each other rather than failing
+        db = sqlite3.connect(database, timeout=60)
+        with db:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions"
+                " (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, mtime_ns INTEGER NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_by_mtime ON sessions (mtime_ns)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS messages"
+                " (session_id INTEGER NOT NULL, seq INTEGER NOT NULL,"
+                " role TEXT NOT NULL, content TEXT NOT NULL, tokens TEXT, summary TEXT,"
+                " PRIMARY KEY (session_id, seq))"
+            )
+            # Databases from before token counts and summaries were saved lack
+            # those columns
+            columns = {row[1] for row in db.execute("PRAGMA table_info(messages)")}
+            for column in ("tokens", "summary"):
+                if column not in columns:
+                    db.execute(f"ALTER TABLE messages ADD COLUMN {column} TEXT")
+        self._connections[database] = db
+        return db
+
+    def _session_id(self, db: sqlite3.Connection, path: pathlib.Path) -> Optional[int]:
+        row = db.execute(
+            "SELECT id FROM sessions WHERE name = ?", (path.name,)
+        ).fetchone()
+        return None if row is None else int(row[0])
+
+    def session_paths(self, directory: pathlib.Path) -> list[pathlib.Path]:
+        db = self._connect(directory)
+        if db is None:
+            return []
+        return [
+            directory / name
+            for (name,) in db.execute("SELECT name FROM sessions ORDER BY name")
+        ]
+
+    def recent_session_paths(
+        self, directory: pathlib.Path, n: int
+    ) -> list[pathlib.Path]:
+        db = self._connect(directory)
+        if db is None:
+            return []
+        return [
+            directory / name
+            for (name,) in db.execute(
+                "SELECT name FROM sessions ORDER BY mtime_ns DESC LIMIT ?", (n,)
+            )
+        ]
+
+    def new_session_path(
+        self, directory: pathlib.Path, session_format: str = "json"
+    ) -> pathlib.Path:
+        # There are no files, so there is no file format to choose
+        return directory / new_session_name()
+
+    def exists(self, path: pathlib.Path) -> bool:
+        db = self._connect(path.parent)
+        return db is not None and self._session_id(db, path) is not None
+
+    @staticmethod
+    def _message_dict(
+        role: str, content: str, tokens: Optional[str], summary: Optional[str]
+    ) -> MessageDict:
+        result: MessageDict = {"role": role, "content": content}
+        if tokens is not None:
+            result["tokens"] = json.loads(tokens)
+        if summary is not None:
+            result["summary"] = json.loads(summary)
+        return result
+
+    @classmethod
+    def _read_message(
+        cls, db: sqlite3.Connection, session_id: int, seq: int
+    ) -> MessageDict:
+        return cls._message_dict(
+            *db.execute(
+                "SELECT role, content, tokens, summary FROM messages WHERE session_id = ? AND seq = ?",
+                (session_id, seq),
+            ).fetchone()
+        )
+
+    def load(self, path: pathlib.Path, lazy: bool = False) -> Session:
+        db = self._connect(path.parent)
+        session_id = None if db is None else self._session_id(db, path)
+        if db is None or session_id is None:
+            raise FileNotFoundError(f"No such session: {path}")
+        session: Session
+        if lazy:
+            # Only the primary key index is read here; each message is read
+            # when it is first used
+            seqs = [
+                seq
+                for (seq,) in db.execute(
+                    "SELECT seq FROM messages WHERE session_id = ? ORDER BY seq",
+                    (session_id,),
+                )
+            ]
+            session = [
+                LazyMessage(functools.partial(self._read_message, db, session_id, seq))
+                for seq in seqs
+            ]
+        else:
+            rows = db.execute(
+                "SELECT seq, role, content, tokens, summary FROM messages WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+            seqs = [row[0] for row in rows]
+            session = [message_from_dict(self._message_dict(*row[1:])) for row in rows]
+        key = (os.path.abspath(path.parent), path.name)
+        self._saved[key] = session_snapshot(session)
+        self._seqs[key] = seqs
+        return session
+
+    def save(self, session: Session, path: pathlib.Path) -> None:
+        """Save a session
+
+        If the messages this process last loaded or saved are an unchanged
+        prefix of the session, only the new messages are inserted, after any
+        that other processes have added in the meantime, and the token counts
+        of the others are updated if they were counted since. Otherwise, the
+        session's rows are replaced."""
+        db = self._connect(path.parent, create=True)
+        assert db is not None
+        key = (os.path.abspath(path.parent), path.name)
+        saved = self._saved.get(key)
+        seqs = self._seqs.get(key, [])
+        with db:
+            # Take the write lock now, so that no other writer can add rows
+            # between finding the end of the session and inserting after it
+            db.execute("BEGIN IMMEDIATE")
+            session_id = self._session_id(db, path)
+            if session_id is None:
+                session_id = db.execute(
+                    "INSERT INTO sessions (name, mtime_ns) VALUES (?, ?)",
+                    (path.name, time.time_ns()),
+                ).lastrowid
+                new, start = session, 0
+            else:
+                db.execute(
+                    "UPDATE sessions SET mtime_ns = ? WHERE id = ?",
+                    (time.time_ns(), session_id),
+                )
+                if saved is not None and snapshot_is_prefix_of(saved, session):
+                    (start,) = db.execute(
+                        "SELECT coalesce(max(seq) + 1, 0) FROM messages WHERE session_id = ?",
+                        (session_id,),
+                    ).fetchone()
+                    new = session[len(saved) :]
+                    # A row is only updated if it still holds the message
+                    db.executemany(
+                        "UPDATE messages SET tokens = ?"
+                        " WHERE session_id = ? AND seq = ? AND content = ?",
+                        [
+                            (json.dumps(tokens), session_id, seq, message.content)
+                            for seq, message in zip(seqs, session[: len(saved)])
+                            if (tokens := message.unsaved_token_counts())
+                        ],
+                    )
+                else:
+                    new, start = session, 0
+            # Read the messages before deleting any rows lazy messages might
+            # still need
+            rows = [
+                (
+                    session_id,
+                    seq,
+                    message.role,
+                    message.content,
+                    json.dumps(tokens) if (tokens := message.token_counts()) else None,
+                    json.dumps(summary) if (summary := message.summary()) else None,
+                )
+                for seq, message in enumerate(new, start)
+            ]
+            if new is session:
+                db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            db.executemany(
+                "INSERT INTO messages (session_id, seq, role, content, tokens, summary)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self._saved[key] = session_snapshot(session)
+        self._seqs[key] = seqs[: len(session) - len(new)] + [row[1] for row in rows]
+        mark_token_counts_saved(session)
+
+    def save_copy(self, session: Session, path: pathlib.Path) -> None:
+        self.save(session, path)
+
+    def search(
+        self,
+        directory: pathlib.Path,
+        rx: re.Pattern[str],
+        jobs: int = 1,
+        first_only: bool = False,
+    ) -> Iterator[Tuple[pathlib.Path, Message]]:
+        db = self._connect(directory)
+        if db is None:
+            return
+        query = (
+            "SELECT s.name, m.role, m.content FROM messages m"
+            " JOIN sessions s ON s.id = m.session_id"
+        )
+        # instr() is case sensitive, so it can only rule out rows without
+        # IGNORECASE
+        literals = [] if rx.flags & re.IGNORECASE else required_literals(rx)
+        if literals:
+            query += " WHERE " + " AND ".join(["instr(m.content, ?)"] * len(literals))
+        query += " ORDER BY s.name, m.seq"
+
+        last_name: Optional[str] = None
+        for name, role, content in db.execute(query, literals):
+            if first_only and name == last_name:
+                continue
+            if rx.search(content):
+                last_name = name
+                yield directory / name, Message(role, content)
+
+
+storage_engines = {"files": FileStorage, "sqlite": SqliteStorage}
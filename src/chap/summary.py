@@ -0,0 +1,152 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import functools
+from typing import Optional
+
+from .core import Backend, response_failed
+from .session import Message, Role, Session, SummaryDict, System
+from .tokens import TokenWindow, in_thread, message_tokens
+
+# A backend can only send as much of a long session as fits in its request
+# size, so the oldest messages are left out. With summaries, the messages left
+# out are instead summarized by the backend itself once enough of them have
+# accumulated, and requests send the system message with the summary
+# appended, followed by the messages after the ones the summary covers. Each
+# summary is kept with the message that was added when it was made, so it is
+# saved in the session like the message itself, and the latest one is found
+# by looking back from the end of the session.
+
+summarize_system_message = """\
+You keep a summary of a conversation between a user and an assistant, for \
+the assistant to continue the conversation from. Keep the facts, names, \
+decisions, instructions and open questions; leave out pleasantries. Reply \
+with just the summary."""
+
+summary_heading = "\n\nA summary of the earlier conversation:\n"
+
+
+def find_summary(session: Session) -> Optional[SummaryDict]:
+    """Return the latest summary in session
+
+    A summary is usually kept with one of the last few messages, so this
+    only reads the whole session when there is none."""
+    for i in range(len(session) - 1, 0, -1):
+        summary = session[i].summary()
+        if summary is not None and 1 <= summary["end"] <= i:
+            return summary
+    return None
+
+
+@functools.lru_cache(maxsize=4)
+def _system_with_summary(system: str, summary: str) -> Message:
+    # The same message each time, so its rendering and token count are
+    # reused from request to request
+    return System(system + summary_heading + summary)
+
+
+def summarized_view(session: Session) -> Session:
+    """Return session as it is to be sent: the system message followed by
+    the messages after those the latest summary covers, with the summary
+    appended to the system message"""
+    summary = find_summary(session)
+    if summary is None:
+        return session[:]
+    system = session[0].content if session[0].role == Role.SYSTEM else ""
+    return [
+        _system_with_summary(system, summary["content"]),
+        *session[summary["end"] :],
+    ]
+
+
+def _transcript(messages: Session) -> str:
+    return "\n\n".join(f"{m.role.upper()}: {m.content}" for m in messages)
+
+
+async def update_summary(
+    api: Backend, session: Session, holder: Message, keep: float
+) -> bool:
+    """After a request for summarized_view(session), if it had to leave out
+    messages, summarize all but the most recent messages that fit in keep
+    (a fraction of the request size)
+
+    The new summary covers the old one and those messages, and is kept with
+    holder (the message just added to session). The requests that follow
+    send the summary and the recent messages, with room to add new ones,
+    until the session no longer fits again. Returns whether a summary was
+    made."""
+    window = getattr(api, "window", None)
+    if not isinstance(window, TokenWindow) or window.left_out is None:
+        return False
+    left_out = window.left_out
+    history, max_tokens, tokenizer = (
+        left_out.history,
+        left_out.max_tokens,
+        left_out.tokenizer,
+    )
+
+    def tokens(message: Message) -> int:
+        return message_tokens(
+            message, tokenizer.name, lambda m: tokenizer.count(m.content)
+        )
+
+    def choose() -> tuple[int, int]:
+        # The recent messages to keep as they are
+        split = len(history)
+        total = 0
+        while (
+            split > 1 and total + (n := tokens(history[split - 1])) <= keep * max_tokens
+        ):
+            total += n
+            split -= 1
+        # The messages before those, up to half of a request (any before
+        # those are lost, as they would be without summaries)
+        first = split
+        total = 0
+        while (
+            first > 1 and total + (n := tokens(history[first - 1])) <= max_tokens // 2
+        ):
+            total += n
+            first -= 1
+        return first, split
+
+    first, split = await in_thread(window, choose)
+    if first == split or split == len(history):
+        return False
+
+    # Where those are in the session; they are near its end
+    positions: dict[int, int] = {}
+    for i in range(len(session) - 1, 0, -1):
+        if session[i] is history[split]:
+            positions[split] = i
+        elif session[i] is history[first]:
+            positions[first] = i
+            break
+    if split not in positions:
+        return False
+
+    old = find_summary(session)
+    query = ""
+    if old is not None:
+        query += f"The summary so far:\n{old['content']}\n\n"
+    query += (
+        "The conversation continued:\n"
+        f"{_transcript(history[first:split])}\n\n"
+        "Write the summary of the whole conversation so far."
+    )
+    content = "".join(
+        [token async for token in api.aask([System(summarize_system_message)], query)]
+    )
+    if response_failed(content):
+        return False
+    holder.set_summary(
+        {
+            "start": positions.get(first, 1) if old is None else old["start"],
+            "end": positions[split],
+            "content": content.strip(),
+        }
+    )
+    return True
@@ -0,0 +1,550 @@
+# SPDX-FileCopyrightText: 2024 Jeff Epler <jepler@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import functools
+import hashlib
+import math
+import os
+import pathlib
+import tempfile
+import threading
+import warnings
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Optional, TypeVar
+
+import httpx
+import platformdirs
+from typing_extensions import Protocol
+
+if TYPE_CHECKING:
+    import tiktoken
+
+from .clients import sync_client
+from .relevance import RelevanceIndex, select_relevant
+from .session import Message, Session
+
+
+class Tokenizer(Protocol):
+    @property
+    def name(self) -> str:
+        """Identifies how tokens are counted, for caching the counts"""
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens in text"""
+
+    def bound(self, text: str) -> int:
+        """Return at least the number of tokens in text, without tokenizing it"""
+
+
+class CharTokenizer:
+    """Estimates tokens from the length of the text, without a tokenizer"""
+
+    def __init__(self, chars_per_token: float = 4.0) -> None:
+        self.chars_per_token = chars_per_token
+
+    @property
+    def name(self) -> str:
+        return f"chars/{self.chars_per_token:g}"
+
+    def count(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+    bound = count
+
+
+# tiktoken downloads encodings on first use, and by default keeps them in a
+# temporary directory; chap keeps them in its cache directory instead, unless
+# the user chose a directory
+tiktoken_cache_path = platformdirs.user_cache_path("chap") / "tiktoken"
+
+tiktoken_url = "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+
+
+def tiktoken_cache_dir() -> Optional[pathlib.Path]:
+    """Return where tiktoken looks for encodings, or None if caching is off"""
+    for var in ("TIKTOKEN_CACHE_DIR", "DATA_GYM_CACHE_DIR"):
+        if var in os.environ:
+            return pathlib.Path(os.environ[var]) if os.environ[var] else None
+    return tiktoken_cache_path
+
+
+def seed_tiktoken_cache(path: pathlib.Path, name: Optional[str] = None) -> str:
+    """Copy an encoding's file (such as o200k_base.tiktoken) into the cache,
+    so that tiktoken finds it there instead of downloading it
+
+    tiktoken checks the file's hash when loading it. Return the name of the
+    encoding."""
+    name = name or path.name.removesuffix(".tiktoken")
+    cache_dir = tiktoken_cache_dir()
+    if cache_dir is None:
+        raise ValueError("The tiktoken cache is disabled (TIKTOKEN_CACHE_DIR is empty)")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # This is how tiktoken names the cached copy of a downloaded file
+    key = hashlib.sha1(tiktoken_url.format(name).encode()).hexdigest()
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=f".{key}", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f, open(path, "rb") as src:
+            while chunk := src.read(1 << 20):
+                f.write(chunk)
+        os.replace(tmp, cache_dir / key)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return name
+
+
+class TiktokenTokenizer:
+    """Counts tokens with one of OpenAI's tiktoken encodings
+
+    The encoding is given by name, or chosen by model name. Neither tiktoken
+    nor the encoding is loaded (or, the first time, downloaded) until
+    something actually has to be counted."""
+
+    def __init__(self, encoding: Optional[str] = None, model: Optional[str] = None):
+        self._encoding = encoding
+        self.model = model
+
+    @functools.cached_property
+    def encoding_name(self) -> str:
+        if self._encoding:
+            return self._encoding
+        import tiktoken.model
+
+        try:
+            return tiktoken.model.encoding_name_for_model(self.model or "")
+        except KeyError:
+            warnings.warn("Warning: model not found. Using cl100k_base encoding.")
+            return "cl100k_base"
+
+    @functools.cached_property
+    def encoding(self) -> tiktoken.Encoding:
+        import tiktoken
+
+        if (
+            "TIKTOKEN_CACHE_DIR" not in os.environ
+            and "DATA_GYM_CACHE_DIR" not in os.environ
+        ):
+            os.environ["TIKTOKEN_CACHE_DIR"] = str(tiktoken_cache_path)
+        return tiktoken.get_encoding(self.encoding_name)
+
+    @property
+    def name(self) -> str:
+        return self.encoding_name
+
+    def count(self, text: str) -> int:
+        # Text that looks like a special token is just text
+        return len(self.encoding.encode_ordinary(text))
+
+    def bound(self, text: str) -> int:
+        # Every token is at least one byte
+        return len(text.encode("utf-8"))
+
+
+class LlamaCppTokenizer:
+    """Counts tokens with a llama.cpp server's /tokenize endpoint
+
+    If the server can't tokenize, the character estimate is used instead."""
+
+    # Short strings, like the parts of prompt templates, are counted again
+    # and again; longer ones are usually messages, whose counts are cached
+    # with them
+    cache_size = 1024
+    max_cached_length = 256
+
+    def __init__(self, url: str, timeout: float = 10) -> None:
+        self.url = str(httpx.URL(url).join("/tokenize"))
+        self.timeout = timeout
+        self.fallback = CharTokenizer()
+        self._available: Optional[bool] = None
+        self._cache: dict[str, int] = {}
+
+    def _tokenize(self, text: str) -> int:
+        response = sync_client(self.url).post(
+            self.url, json={"content": text}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return len(response.json()["tokens"])
+
+    @property
+    def available(self) -> bool:
+        if self._available is None:
+            try:
+                self._tokenize("")
+                self._available = True
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                warnings.warn(f"{self.url} can't count tokens, estimating them: {e}")
+                self._available = False
+        return self._available
+
+    @property
+    def name(self) -> str:
+        if not self.available:
+            return self.fallback.name
+        return f"llama.cpp {self.url}"
+
+    def bound(self, text: str) -> int:
+        # Most tokens are at least one byte, but the tokenizer may add a
+        # space at the start
+        return len(text.encode("utf-8")) + 1
+
+    def count(self, text: str) -> int:
+        if not self.available:
+            return self.fallback.count(text)
+        if (n := self._cache.get(text)) is not None:
+            return n
+        n = self._tokenize(text)
+        if len(text) <= self.max_cached_length and len(self._cache) < self.cache_size:
+            self._cache[text] = n
+        return n
+
+
+# How a backend's 'tokenizer' parameter is interpreted: the name of a
+# tokenizer, optionally followed by a colon and an argument
+tokenizers: dict[str, Callable[..., Tokenizer]] = {
+    "chars": lambda arg, **context: CharTokenizer(float(arg or 4)),
+    "tiktoken": lambda arg, **context: TiktokenTokenizer(arg, context.get("model")),
+    "llama.cpp": lambda arg, **context: LlamaCppTokenizer(arg or context["url"]),
+}
+
+
+@functools.cache
+def _get_tokenizer(spec: str, context: tuple[tuple[str, Any], ...]) -> Tokenizer:
+    name, _, arg = spec.partition(":")
+    factory = tokenizers.get(name)
+    if factory is None:
+        raise ValueError(
+            f"Unknown tokenizer {name!r} (choose from {', '.join(tokenizers)})"
+        )
+    return factory(arg or None, **dict(context))
+
+
+def get_tokenizer(spec: str, **context: Any) -> Tokenizer:
+    """Return the tokenizer described by spec, such as 'chars', 'chars:3.5',
+    'tiktoken:o200k_base' or 'llama.cpp:http://localhost:8080'
+
+    context gives defaults for the argument: the model (for tiktoken) or
+    the server url (for llama.cpp) the backend is using. Tokenizers are
+    shared by all the requests that use the same spec and context."""
+    return _get_tokenizer(spec, tuple(sorted(context.items())))
+
+
+def message_tokens(
+    message: Message, encoding: str, count: Callable[[Message], int]
+) -> int:
+    """Return the number of tokens in message, counting them only if they
+    aren't already known for this encoding
+
+    The count is kept with the message, and saved with it in session files."""
+    counts = message.token_counts()
+    if counts is not None and (n := counts.get(encoding)) is not None:
+        return n
+    n = count(message)
+    message.set_token_count(encoding, n)
+    return n
+
+
+@dataclass(frozen=True)
+class LeftOut:
+    """The messages a request left out of a long session: history[1:start]"""
+
+    history: Session
+    start: int
+    max_tokens: int
+    tokenizer: Tokenizer
+
+
+class TokenWindow:
+    """Finds the longest tail of a session that fits in a token budget
+
+    Running totals of the messages' token counts are kept between requests,
+    so when a session has only grown since the last request, choosing the
+    tail is a binary search, plus counting just the new messages. The totals
+    only cover the messages from the start of the last window onward; they
+    are extended further back only if that window no longer fills the
+    budget."""
+
+    def __init__(self) -> None:
+        # The encoding and per-message overhead the totals were computed with
+        self.key: tuple[str, int] | None = None
+        self.start = 0
+        # The messages from start onward, and the total tokens of the first i
+        # of them
+        self.messages: list[Message] = []
+        self.sums = [0]
+        # How many tokens of the last request (as chosen by fit_history) the
+        # session's previous request started with, and its total
+        self.reuse = (0, 0)
+        # The messages the last request left out, if any
+        self.left_out: Optional[LeftOut] = None
+        # For choosing earlier messages by relevance instead of recency
+        self.relevance = RelevanceIndex()
+        # The tokenizer messages were last counted with, if they had to be
+        self.tokenizer: Optional[Tokenizer] = None
+        # Held while a request is built with the window (see in_thread)
+        self.lock = threading.Lock()
+
+    def count_response(self, message: Message) -> None:
+        """Count the tokens of a response to the last request, if the window
+        counts messages, so that the count is saved along with the response
+        (the next request would count it anyway)"""
+        tokenizer = self.tokenizer
+        if tokenizer is not None:
+            message_tokens(
+                message, tokenizer.name, lambda m: tokenizer.count(m.content)
+            )
+
+    def _common_length(self, history: Session) -> int:
+        # Sessions change by adding and removing messages at the end, so the
+        # messages that are still the same form a prefix and can be found by
+        # bisection
+        lo, hi = 0, min(len(self.messages), len(history) - self.start)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if history[self.start + mid] is self.messages[mid]:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _reset(self, start: int) -> None:
+        self.start = start
+        del self.messages[:]
+        del self.sums[1:]
+
+    def _extend(
+        self,
+        messages: Session,
+        encoding: str,
+        count: Callable[[Message], int],
+        per_message: int,
+    ) -> None:
+        for message in messages:
+            self.messages.append(message)
+            self.sums.append(
+                self.sums[-1] + message_tokens(message, encoding, count) + per_message
+            )
+
+    def window_start(
+        self,
+        history: Session,
+        budget: int,
+        encoding: str,
+        count: Callable[[Message], int],
+        per_message: int = 0,
+        first: int = 1,
+        chunk: int = 0,
+    ) -> int:
+        """Return the smallest index at least first, such that the messages of
+        history from there on need at most budget tokens
+
+        count(message) gives the number of tokens in a message in the given
+        encoding, and each message takes per_message more tokens than that.
+
+        With chunk, once messages have to be left out, up to chunk tokens
+        more are left out, choosing the start so that it stays the same as
+        the session grows (see _chunk_start)."""
+        key = (encoding, per_message)
+        if key != self.key or not (first <= self.start <= len(history)):
+            self.key = key
+            self._reset(len(history))
+        common = self._common_length(history)
+        if common:
+            del self.messages[common:]
+            del self.sums[common + 1 :]
+        else:
+            self._reset(len(history))
+        self._extend(history[self.start + common :], encoding, count, per_message)
+        return self._start(history, len(history), budget, count, first, chunk)
+
+    def _start(
+        self,
+        history: Session,
+        n: int,
+        budget: int,
+        count: Callable[[Message], int],
+        first: int,
+        chunk: int,
+    ) -> int:
+        # The window_start of history[:n], which the window covers from
+        # self.start on
+        start = self._min_start(history, n, budget, count, first)
+        if chunk and start > first:
+            start = self._chunk_start(n, start, budget - chunk)
+        return start
+
+    def _min_start(
+        self,
+        history: Session,
+        n: int,
+        budget: int,
+        count: Callable[[Message], int],
+        first: int,
+    ) -> int:
+        assert self.key is not None
+        encoding, per_message = self.key
+        end = n - self.start
+        total = self.sums[end]
+        if total > budget:
+            i = bisect.bisect_left(self.sums, total - budget, 0, end + 1)
+            # If even no messages are too many (budget < 0), none are sent
+            return self.start + min(i, end)
+
+        # Everything from start on fits, so see how much further back the
+        # window can go
+        start = self.start
+        while start > first:
+            m = message_tokens(history[start - 1], encoding, count) + per_message
+            if total + m > budget:
+                break
+            total += m
+            start -= 1
+        if start < self.start:
+            self._reset(start)
+            self._extend(history[start:], encoding, count, per_message)
+        return start
+
+    def _chunk_start(self, n: int, lo: int, budget: int) -> int:
+        # Starting anywhere from lo to the last index that leaves at least
+        # budget tokens (but at least one message) is acceptable. Choose the
+        # index in that range which is a multiple of the highest power of two:
+        # as messages are added and the range moves, the same index stays the
+        # choice until lo passes it, and then the next choice is usually well
+        # ahead.
+        end = n - self.start
+        total = self.sums[end]
+        k = bisect.bisect_right(self.sums, total - max(budget, 0), 0, end + 1) - 1
+        hi = max(lo, min(self.start + k, n - 1))
+        shift = (hi ^ (lo - 1)).bit_length() - 1
+        return (hi >> shift) << shift
+
+    def reused_tokens(
+        self,
+        history: Session,
+        start: int,
+        budget: int,
+        count: Callable[[Message], int],
+        first: int = 1,
+        chunk: int = 0,
+    ) -> int:
+        """Return how many tokens of history[start:] (as just returned by
+        window_start) were also at the start of the window for history
+        without its last exchange (the previous request of a session), and
+        so might be reused from a server's prompt cache"""
+        n = len(history) - 2
+        if n <= start:
+            return 0
+        if self._start(history, n, budget, count, first, chunk) != start:
+            return 0
+        return self.sums[n - self.start] - self.sums[start - self.start]
+
+
+# Chat APIs wrap each message in a few tokens of markup, naming its role
+chat_message_tokens = 4
+
+
+def fit_history(
+    window: TokenWindow,
+    tokenizer: Tokenizer,
+    history: Session,
+    max_tokens: int,
+    per_message: int = 0,
+    overhead: int = 0,
+    chunk: float = 0,
+    relevant: bool = False,
+) -> Session:
+    """Return the first (system) message of history, followed by as many of
+    the most recent messages as fit in max_tokens
+
+    Each message takes its content's tokens plus per_message, and the
+    request as a whole takes overhead more. Until the window has had to
+    count messages, a history that fits even by the tokenizer's upper bound
+    is sent without counting anything (so the tokenizer need not even be
+    loaded).
+
+    When messages have to be left out, about chunk (a fraction of
+    max_tokens) more are left out at once, so that later requests start
+    with the same messages until the session has grown by that much; servers
+    that cache the processed start of a prompt can then reuse it. How much
+    of this request the previous request of the session started with is
+    left in window.reuse, and which messages were left out in
+    window.left_out.
+
+    With relevant, only the most recent messages that fit in half of
+    max_tokens are sent, and the rest is filled with the earlier exchanges
+    that best match the last message (see select_relevant). Those change
+    from question to question, so only the system message counts as
+    reused."""
+    if window.tokenizer is None:
+        # Once the window counts messages, finding the tail is cheaper than
+        # going over the whole session for the bound
+        left = max_tokens - overhead
+        new = 0
+        for i, message in enumerate(reversed(history)):
+            size = tokenizer.bound(message.content) + per_message
+            left -= size
+            if i < 2:
+                new += size
+            if left < 0:
+                break
+        else:
+            total = max_tokens - left
+            window.reuse = (total - new if len(history) > 2 else 0), total
+            window.left_out = None
+            return history[:]
+
+    def count(message: Message) -> int:
+        return tokenizer.count(message.content)
+
+    window.tokenizer = tokenizer
+    name = tokenizer.name
+    fixed = overhead + message_tokens(history[0], name, count) + per_message
+    left = max_tokens - fixed
+    if relevant:
+        start = window.window_start(history, left // 2, name, count, per_message)
+        start = min(start, len(history) - 1)
+
+        def tokens(message: Message) -> int:
+            return message_tokens(message, name, count) + per_message
+
+        sent = sum(map(tokens, history[start:]))
+        earlier = select_relevant(window.relevance, history, start, left - sent, tokens)
+        sent += sum(map(tokens, earlier))
+        window.reuse = fixed, fixed + sent
+        window.left_out = (
+            LeftOut(history, start, max_tokens, tokenizer) if start > 1 else None
+        )
+        return [history[0], *earlier, *history[start:]]
+
+    size = int(chunk * max_tokens)
+    start = window.window_start(history, left, name, count, per_message, chunk=size)
+    sent = window.sums[-1] - window.sums[start - window.start]
+    reused = window.reused_tokens(history, start, left, count, chunk=size)
+    window.reuse = fixed + reused, fixed + sent
+    window.left_out = (
+        LeftOut(history, start, max_tokens, tokenizer) if start > 1 else None
+    )
+    return [history[0], *history[start:]]
+
+
+T = TypeVar("T")
+
+
+async def in_thread(window: TokenWindow, build: Callable[[], T]) -> T:
+    """Return build(), run in a thread while holding window.lock
+
+    Backends build requests, and count their responses, with this from
+    their async methods: counting tokens can take a while, and the llama.cpp
+    tokenizer even asks a server, which would hold up the event loop (and
+    the tui with it). A backend's requests are built one at a time, since
+    they share the window and other caches."""
+
+    def locked() -> T:
+        with window.lock:
+            return build()
+
+    return await asyncio.to_thread(locked)